@@ -1,5 +1,6 @@
 from django.contrib import admin
 
+from lizard_graph.metadata import metadata
 from lizard_graph.models import GraphItem
 from lizard_graph.models import PredefinedGraph
 
@@ -19,10 +20,13 @@ class GraphItemInline(admin.TabularInline):
         """
         formfield = super(GraphItemInline, self).formfield_for_dbfield(
             db_field, **kwargs)
-        if db_field.name in ['location', 'parameter',
-                             'module', 'time_step', 'qualifierset']:
-            # dirty trick so queryset is evaluated and cached in .choices
-            formfield.choices = formfield.choices
+        models = dict(GraphItem.METADATA_FIELDS)
+        if db_field.name in models:
+            # Take the choices from the metadata index instead of
+            # evaluating the queryset for every inline.
+            formfield.choices = [('', formfield.empty_label)] + [
+                (obj.pk, unicode(obj))
+                for obj in metadata.all(models[db_field.name])]
         return formfield
 
 
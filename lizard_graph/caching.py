@@ -0,0 +1,703 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Caching of time series and rendered graphs.
+
+Time series are cached in aligned chunks: calendar months for raw
+events, calendar years for aggregated events. A requested window is
+put together from the cached chunks, only missing chunks are fetched.
+This way panning or zooming a graph reuses almost all cached data.
+Every chunk carries a data watermark; a chunk is only used when its
+watermark matches the current one in the database, or, in
+stale-while-revalidate mode, while it is refreshed in the background.
+
+Time series chunks go through a two tier cache: a small in-process
+LRU cache in front of the shared Django cache, which stores them in a
+compact serialized form (see serialization.py).
+
+Rendered graphs are cached by a canonical form of the request,
+including the version of the graph definitions.
+"""
+import cPickle as pickle
+import hashlib
+import logging
+import Queue
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from lizard_graph.columnar import ColumnarSeries
+from lizard_graph.columnar import as_utc
+from lizard_graph.serialization import PartitionedCache
+from lizard_graph.serialization import chunk_size
+
+
+logger = logging.getLogger(__name__)
+
+
+# Cached chunks are checked against the data watermarks, so they can
+# live long.
+TIME_SERIES_CACHE_TIMEOUT = getattr(
+    settings, 'LIZARD_GRAPH_TIME_SERIES_CACHE_TIMEOUT', 24 * 60 * 60)
+
+# Rendered graphs do not know when their data changes, so they expire.
+RENDER_CACHE_TIMEOUT = getattr(
+    settings, 'LIZARD_GRAPH_RENDER_CACHE_TIMEOUT', 5 * 60)
+
+# Maximum (approximate) size in bytes of the in-process cache, per
+# worker process.
+LOCAL_CACHE_SIZE = getattr(
+    settings, 'LIZARD_GRAPH_LOCAL_CACHE_SIZE', 64 * 1024 * 1024)
+
+# Seconds an entry is kept in the in-process cache. The remaining
+# lifetime of an entry in the shared cache is unknown, so local copies
+# are kept shortly.
+LOCAL_CACHE_TIMEOUT = getattr(
+    settings, 'LIZARD_GRAPH_LOCAL_CACHE_TIMEOUT', 5 * 60)
+
+DEFINITIONS_VERSION_KEY = 'lizard_graph::definitions_version'
+
+
+def approximate_size(value):
+    """
+    Return approximate size in bytes of value: its pickled size.
+    """
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+class LocalLRUCache(object):
+    """
+    In-process cache with a maximum total size, least recently used
+    entries are evicted first.
+
+    The size of an entry is estimated with sizeof(value). Entries
+    bigger than the total size are not stored.
+    """
+    def __init__(self, max_size, sizeof=approximate_size):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        # key -> (value, size, expires)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            value, size, expires = entry
+            if expires is not None and expires < time.time():
+                self.size -= size
+                return default
+            # Re-insert: most recently used entries are at the end.
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None):
+        size = self.sizeof(value)
+        expires = None
+        if timeout is not None:
+            expires = time.time() + timeout
+        with self._lock:
+            self._delete(key)
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_size:
+                oldest_key = next(iter(self._entries))
+                self._delete(oldest_key)
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+class TwoTierCache(object):
+    """
+    Local LRU cache in front of the shared Django cache.
+
+    Lookups first go to the local cache, misses fall through to the
+    shared cache. Hits from the shared cache are kept locally for
+    local_timeout seconds, so local copies do not outlive the shared
+    entries by long.
+    """
+    def __init__(self, local, shared, local_timeout=LOCAL_CACHE_TIMEOUT):
+        self.local = local
+        self.shared = shared
+        self.local_timeout = local_timeout
+
+    def get_many(self, keys, accept=None):
+        """
+        If provided, accept(key, value) tells whether a local value is
+        still good. Otherwise the shared cache is tried, another worker
+        may have stored a newer value there.
+        """
+        result = {}
+        missing = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is None or (accept is not None and
+                                 not accept(key, value)):
+                missing.append(key)
+            else:
+                result[key] = value
+        if missing:
+            from_shared = self.shared.get_many(missing)
+            for key, value in from_shared.items():
+                self.local.set(key, value, self.local_timeout)
+            result.update(from_shared)
+        return result
+
+    def set_many(self, data, timeout=None):
+        local_timeout = self.local_timeout
+        if timeout is not None:
+            local_timeout = min(timeout, local_timeout)
+        for key, value in data.items():
+            self.local.set(key, value, local_timeout)
+        self.shared.set_many(data, timeout)
+
+
+class SingleFlight(object):
+    """
+    Make sure that only one worker fetches a missing cache entry at a
+    time, the others wait for the result.
+
+    The locks are kept in the Django cache with cache.add, which is
+    atomic. They expire after lock_timeout, in case a worker dies
+    while holding one.
+    """
+    def __init__(self, lock_cache, result_cache, lock_timeout=60,
+                 wait_timeout=30, poll_interval=0.1):
+        self.lock_cache = lock_cache
+        self.result_cache = result_cache
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+
+    def _lock_key(self, key):
+        return 'lock::%s' % key
+
+    def acquire(self, key):
+        """
+        Return True if the lock of key is acquired.
+        """
+        return self.lock_cache.add(
+            self._lock_key(key), 1, self.lock_timeout)
+
+    def release(self, key):
+        self.lock_cache.delete(self._lock_key(key))
+
+    def _poll(self, keys, accept, result):
+        for key, value in self.result_cache.get_many(keys).items():
+            if accept is None or accept(key, value):
+                result[key] = value
+
+    def wait(self, keys, accept=None):
+        """
+        Wait for keys to appear in the result cache. Return dict with
+        the results that appeared within wait_timeout.
+
+        Keys of which the lock is released without a result (the
+        worker holding it failed) are not waited for any longer.
+
+        If provided, accept(key, value) tells whether a value in the
+        cache is the awaited result (and not an old one).
+        """
+        result = {}
+        waiting = list(keys)
+        deadline = time.time() + self.wait_timeout
+        while True:
+            self._poll(waiting, accept, result)
+            waiting = [key for key in waiting if key not in result]
+            if not waiting or time.time() > deadline:
+                return result
+            locked = self.lock_cache.get_many(
+                [self._lock_key(key) for key in waiting])
+            released = [key for key in waiting
+                        if self._lock_key(key) not in locked]
+            if released:
+                # The result may have been stored just before the lock
+                # was released.
+                self._poll(released, accept, result)
+                waiting = [key for key in waiting if key not in released]
+                if not waiting:
+                    return result
+            time.sleep(self.poll_interval)
+
+
+# Background refreshes run in a fixed number of threads per process.
+# When too many are waiting, new ones are skipped.
+BACKGROUND_WORKERS = getattr(settings, 'LIZARD_GRAPH_BACKGROUND_WORKERS', 2)
+BACKGROUND_QUEUE_SIZE = getattr(
+    settings, 'LIZARD_GRAPH_BACKGROUND_QUEUE_SIZE', 100)
+
+_background_jobs = Queue.Queue(BACKGROUND_QUEUE_SIZE)
+_background_threads = []
+_background_threads_lock = threading.Lock()
+
+
+def _background_worker():
+    while True:
+        function = _background_jobs.get()
+        try:
+            function()
+        except:
+            logger.exception("Error in background refresh.")
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+
+def in_background(function):
+    """
+    Run function in one of the BACKGROUND_WORKERS background threads.
+    Errors are logged, database connections are closed afterwards.
+
+    Returns False if function is skipped, because too many functions
+    are waiting already.
+    """
+    with _background_threads_lock:
+        while len(_background_threads) < BACKGROUND_WORKERS:
+            thread = threading.Thread(target=_background_worker)
+            thread.daemon = True
+            thread.start()
+            _background_threads.append(thread)
+    try:
+        _background_jobs.put_nowait(function)
+    except Queue.Full:
+        logger.warning("Too many background refreshes, skipped one.")
+        return False
+    return True
+
+
+# Values from the cache are shared between requests: treat them as
+# read-only. The shared cache holds compact serialized chunks.
+time_series_cache = TwoTierCache(
+    LocalLRUCache(LOCAL_CACHE_SIZE, sizeof=chunk_size),
+    PartitionedCache(cache))
+
+# Waiters poll the shared cache only: results of other workers never
+# show up in the local cache.
+single_flight = SingleFlight(
+    cache, time_series_cache.shared,
+    wait_timeout=getattr(settings, 'LIZARD_GRAPH_SINGLE_FLIGHT_WAIT', 30))
+
+
+def period_start(dt, period):
+    """
+    Return start of period ('day', 'month', 'quarter', 'year')
+    containing dt. The tzinfo of dt is kept.
+    """
+    dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'day':
+        return dt
+    if period == 'month':
+        return dt.replace(day=1)
+    if period == 'quarter':
+        return dt.replace(month=((dt.month - 1) // 3) * 3 + 1, day=1)
+    if period == 'year':
+        return dt.replace(month=1, day=1)
+    raise ValueError('Unknown period %s' % period)
+
+
+def _next_month(dt):
+    if dt.month == 12:
+        return dt.replace(year=dt.year + 1, month=1)
+    return dt.replace(month=dt.month + 1)
+
+
+def _next_year(dt):
+    return dt.replace(year=dt.year + 1)
+
+
+def month_chunks(dt_start, dt_end):
+    """
+    Return list of (chunk_start, chunk_end) of the calendar months
+    that cover dt_start up to and including dt_end. The chunks are in
+    UTC, whatever the timezone of dt_start and dt_end.
+    """
+    return _chunks(
+        period_start(as_utc(dt_start), 'month'), as_utc(dt_end), _next_month)
+
+
+def year_chunks(dt_start, dt_end):
+    """
+    Return list of (chunk_start, chunk_end) of the calendar years that
+    cover dt_start up to and including dt_end. The chunks are in UTC,
+    whatever the timezone of dt_start and dt_end.
+    """
+    return _chunks(
+        period_start(as_utc(dt_start), 'year'), as_utc(dt_end), _next_year)
+
+
+def _chunks(chunk_start, dt_end, next_chunk):
+    result = []
+    while chunk_start <= dt_end:
+        chunk_end = next_chunk(chunk_start)
+        result.append((chunk_start, chunk_end))
+        chunk_start = chunk_end
+    return result
+
+
+def contiguous_runs(indices):
+    """
+    Return sorted indices as list of (first, last) of the runs of
+    consecutive indices: [0, 1, 3] -> [(0, 1), (3, 3)].
+    """
+    runs = []
+    for index in sorted(indices):
+        if runs and runs[-1][1] == index - 1:
+            runs[-1] = (runs[-1][0], index)
+        else:
+            runs.append((index, index))
+    return runs
+
+
+def chunk_key(key_prefix, chunk_start):
+    return ('%s::%s' % (
+            key_prefix, chunk_start.strftime('%Y%m%d'))).replace(' ', '_')
+
+
+def split_in_chunks(ts_dict, chunks):
+    """
+    Split time series dict in a time series dict per chunk.
+
+    Every chunk gets all keys of ts_dict, also when there are no events
+    in that chunk: the meta data (units etc.) is needed anyway.
+    """
+    result = [{} for chunk in chunks]
+    for key, ts in ts_dict.items():
+        for chunk, (chunk_start, chunk_end) in zip(result, chunks):
+            chunk[key] = ts.window(
+                chunk_start, chunk_end, include_end=False).clone(
+                with_events=True)
+    return result
+
+
+def merge_chunks(chunk_dicts, dt_start, dt_end):
+    """
+    Merge time series dicts of consecutive chunks in a single time
+    series dict with all events from dt_start up to and including
+    dt_end.
+    """
+    parts = {}
+    for chunk in chunk_dicts:
+        for key, ts in chunk.items():
+            parts.setdefault(key, []).append(ts.window(dt_start, dt_end))
+    # concatenate always copies: the result never shares arrays with
+    # the (locally) cached chunks.
+    return dict([(key, ColumnarSeries.concatenate(key_parts))
+                 for key, key_parts in parts.items()])
+
+
+def cached_chunked(graph_items, key_function, chunks, fetch_function,
+                   watermark_function, dt_start, dt_end, expire_after=None):
+    """
+    Return dict id(graph_item) -> time series dict from dt_start up to
+    and including dt_end, put together from cached chunks.
+
+    Graph items with the same key need the same data: only the first
+    of them is looked up, fetched and stored. The others share its
+    time series dict, so treat the result as read-only. See
+    _cached_chunked for the arguments.
+    """
+    graph_item_keys = {}
+    unique = {}  # key -> first graph item with that key
+    unique_graph_items = []
+    for graph_item in graph_items:
+        key = key_function(graph_item)
+        graph_item_keys[id(graph_item)] = key
+        if key not in unique:
+            unique[key] = graph_item
+            unique_graph_items.append(graph_item)
+
+    unique_result = _cached_chunked(
+        unique_graph_items, key_function, chunks, fetch_function,
+        watermark_function, dt_start, dt_end, expire_after=expire_after)
+
+    result = {}
+    for graph_item in graph_items:
+        first = unique[graph_item_keys[id(graph_item)]]
+        if id(first) in unique_result:
+            result[id(graph_item)] = unique_result[id(first)]
+    return result
+
+
+def _cached_chunked(graph_items, key_function, chunks, fetch_function,
+                    watermark_function, dt_start, dt_end, expire_after=None):
+    """
+    Return dict id(graph_item) -> time series dict from dt_start up to
+    and including dt_end, put together from cached chunks.
+
+    key_function(graph_item) returns the key prefix of a graph item,
+    chunks is a list of (chunk_start, chunk_end) covering the window.
+
+    watermark_function(graph_items, chunks) returns dict id(graph_item)
+    -> list of current watermarks per chunk, with a single query per
+    source. Cached chunks with another watermark are stale.
+
+    Missing and stale chunks are fetched with
+    fetch_function(graph_items, fetch_start, fetch_end), with a half
+    open window. Graph items that miss the same chunks are fetched
+    together, with one call per contiguous run of missing chunks.
+    Chunks that are already being fetched by another worker are waited
+    for (single flight).
+
+    Stale-while-revalidate: if expire_after (seconds) is given, stale
+    chunks that were stored less than expire_after seconds ago are
+    used anyway and refreshed in a background thread.
+    """
+    chunk_keys = {}
+    for graph_item in graph_items:
+        key_prefix = key_function(graph_item)
+        chunk_keys[id(graph_item)] = [
+            chunk_key(key_prefix, chunk_start)
+            for chunk_start, chunk_end in chunks]
+    # key -> (graph_item, chunk index)
+    chunk_of_key = {}
+    for graph_item in graph_items:
+        for index, key in enumerate(chunk_keys[id(graph_item)]):
+            chunk_of_key[key] = (graph_item, index)
+
+    # The watermarks are determined before fetching: when data comes in
+    # while fetching, the stored watermark is outdated and the chunk is
+    # refetched next time. Not the other way around.
+    watermarks = watermark_function(graph_items, chunks)
+
+    def is_current(graph_item, index, value):
+        return (id(graph_item) not in watermarks or
+                value['watermark'] == watermarks[id(graph_item)][index])
+
+    def is_current_key(key, value):
+        graph_item, index = chunk_of_key[key]
+        return is_current(graph_item, index, value)
+
+    # Outdated local chunks are looked up in the shared cache as well.
+    cached = time_series_cache.get_many(
+        chunk_of_key.keys(), accept=is_current_key)
+
+    valid = {}
+    stale = {}
+    now = time.time()
+    for graph_item in graph_items:
+        for index, key in enumerate(chunk_keys[id(graph_item)]):
+            if key not in cached:
+                continue
+            if is_current(graph_item, index, cached[key]):
+                valid[key] = cached[key]['data']
+            elif (expire_after is not None and
+                  now - cached[key]['stored'] < expire_after):
+                stale[key] = cached[key]['data']
+
+    def missing_keys(graph_item):
+        return [key for key in chunk_keys[id(graph_item)]
+                if key not in valid]
+
+    def fetch_and_store(item_keys):
+        """
+        Fetch and store keys (that are not valid) of graph items;
+        item_keys is a list of (graph_item, keys).
+        """
+        # Graph items by the chunks they miss.
+        item_sets = {}
+        for graph_item, keys in item_keys:
+            missing_chunks = tuple(
+                index for index, key in enumerate(chunk_keys[id(graph_item)])
+                if key in keys and key not in valid)
+            if missing_chunks:
+                item_sets.setdefault(missing_chunks, []).append(graph_item)
+        to_cache = {}
+        for missing_chunks, items in item_sets.items():
+            for first, last in contiguous_runs(missing_chunks):
+                fetch_chunks = chunks[first:last + 1]
+                fetched = fetch_function(
+                    items, fetch_chunks[0][0], fetch_chunks[-1][1])
+                stored = time.time()
+                for graph_item in items:
+                    if id(graph_item) not in fetched:
+                        continue
+                    item_watermarks = watermarks.get(
+                        id(graph_item), [None] * len(chunks))
+                    keys = chunk_keys[id(graph_item)]
+                    for index, chunk in zip(
+                        range(first, last + 1),
+                        split_in_chunks(
+                            fetched[id(graph_item)], fetch_chunks)):
+                        valid[keys[index]] = chunk
+                        to_cache[keys[index]] = {
+                            'watermark': item_watermarks[index],
+                            'stored': stored,
+                            'data': chunk}
+        time_series_cache.set_many(to_cache, TIME_SERIES_CACHE_TIMEOUT)
+
+    # Graph items that can be served completely from (stale) cache are
+    # refreshed in the background.
+    refresh_items = []
+    refresh_locks = []
+    fetch_items = []
+    for graph_item in graph_items:
+        keys = missing_keys(graph_item)
+        if not keys:
+            continue
+        if [key for key in keys if key not in stale]:
+            fetch_items.append(graph_item)
+        elif single_flight.acquire('refresh::%s' % keys[0]):
+            refresh_items.append(graph_item)
+            refresh_locks.append('refresh::%s' % keys[0])
+
+    if refresh_items:
+        def refresh():
+            try:
+                fetch_and_store([(graph_item, missing_keys(graph_item))
+                                 for graph_item in refresh_items])
+            finally:
+                for key in refresh_locks:
+                    single_flight.release(key)
+        if not in_background(refresh):
+            for key in refresh_locks:
+                single_flight.release(key)
+
+    # Single flight: chunks that another worker is already fetching
+    # are not fetched again, we wait for the result instead. Chunks
+    # shared by graph items are fetched once.
+    owned = []
+    wait_keys = set()
+    locks = set()
+    for graph_item in fetch_items:
+        acquired = []
+        for key in missing_keys(graph_item):
+            if key in locks or key in wait_keys:
+                continue
+            if single_flight.acquire(key):
+                locks.add(key)
+                acquired.append(key)
+            else:
+                wait_keys.add(key)
+        if acquired:
+            owned.append((graph_item, acquired))
+    try:
+        if owned:
+            fetch_and_store(owned)
+    finally:
+        for key in locks:
+            single_flight.release(key)
+
+    if wait_keys:
+        found = single_flight.wait(wait_keys, accept=is_current_key)
+        for key, value in found.items():
+            valid[key] = value['data']
+    # Whatever did not show up (the other worker failed or took too
+    # long), we fetch ourselves. What we failed to fetch ourselves is
+    # not tried again.
+    still_missing = []
+    for graph_item in fetch_items:
+        keys = [key for key in missing_keys(graph_item) if key not in locks]
+        if keys:
+            still_missing.append((graph_item, keys))
+    if still_missing:
+        fetch_and_store(still_missing)
+
+    result = {}
+    for graph_item in graph_items:
+        keys = chunk_keys[id(graph_item)]
+        data = [valid.get(key, stale.get(key)) for key in keys]
+        if None in data:
+            # Fetching went wrong.
+            continue
+        result[id(graph_item)] = merge_chunks(data, dt_start, dt_end)
+    return result
+
+
+def definitions_version():
+    """
+    Return version of the predefined graph definitions.
+
+    The version changes whenever a PredefinedGraph or GraphItem is
+    saved or deleted, see bump_definitions_version.
+    """
+    version = cache.get(DEFINITIONS_VERSION_KEY)
+    if version is None:
+        # Unknown (i.e. expired): start a new, unique version.
+        version = int(time.time() * 1000)
+        cache.add(DEFINITIONS_VERSION_KEY, version)
+        version = cache.get(DEFINITIONS_VERSION_KEY, version)
+    return version
+
+
+def bump_definitions_version(**kwargs):
+    """
+    Signal handler: the predefined graph definitions have changed.
+    """
+    try:
+        cache.incr(DEFINITIONS_VERSION_KEY)
+    except ValueError:
+        # Key does not exist: the next definitions_version call starts
+        # a new one.
+        pass
+
+
+def render_cache_key(params, dt_start, dt_end):
+    """
+    Return cache key for a rendered graph.
+
+    params is a QueryDict (request.GET), dt_start and dt_end the
+    normalized time range. dt_start and dt_end in params are ignored
+    in favour of the normalized ones.
+    """
+    canonical = []
+    for key in sorted(params.keys()):
+        if key in ('dt_start', 'dt_end'):
+            continue
+        for value in params.getlist(key):
+            canonical.append((key, value))
+    canonical.append(('dt_start', dt_start.isoformat()))
+    canonical.append(('dt_end', dt_end.isoformat()))
+    canonical.append(('version', definitions_version()))
+    digest = hashlib.md5(repr(canonical)).hexdigest()
+    return 'lizard_graph::render::%s' % digest
+
+
+def rendered_from_response(response):
+    """
+    Return cacheable dict with the content and headers of response.
+    """
+    content = response.content
+    return {
+        'content': content,
+        'content_type': response['Content-Type'],
+        'content_disposition': response.get('Content-Disposition'),
+        'etag': '"%s"' % hashlib.md5(content).hexdigest(),
+        'last_modified': time.time(),
+        }
+
+
+def etag_matches(request, etag):
+    """
+    Return True if If-None-Match of request matches etag.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    etags = []
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        # If-None-Match uses the weak comparison: W/"x" matches "x".
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        etags.append(tag)
+    return etag in etags or '*' in etags
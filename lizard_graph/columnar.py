@@ -0,0 +1,397 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Column based time series.
+
+A timeseries.TimeSeries is a dict of datetime -> (value, flag,
+comment): arithmetic and plotting walk that dict in Python. A
+ColumnarSeries keeps the events in arrays instead: timestamps as int64
+seconds since epoch, values as float64 (missing values are NaN), flags
+as int16 and comments as an optional object array. Arithmetic works on
+whole arrays.
+
+ColumnarSeries has the same metadata attributes and arithmetic as
+TimeSeries, and converts from and to it.
+"""
+import calendar
+import datetime
+
+import numpy as np
+from iso8601.iso8601 import UTC
+from matplotlib.dates import date2num
+from timeseries import timeseries
+
+
+NO_FLAG = -1
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Matplotlib date number of the epoch.
+EPOCH_DATE_NUMBER = date2num(datetime.datetime(1970, 1, 1))
+
+
+def epoch_seconds(dt):
+    """
+    Return seconds since epoch of dt. Naive datetimes are taken as UTC.
+    """
+    if dt.tzinfo is not None:
+        return calendar.timegm(dt.utctimetuple())
+    return calendar.timegm(dt.timetuple())
+
+
+def as_utc(dt):
+    """
+    Return dt as aware datetime in UTC. Naive datetimes are taken as
+    UTC, like epoch_seconds does.
+    """
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=UTC)
+    return dt.astimezone(UTC)
+
+
+def datetime_from_epoch(seconds, aware):
+    dt = datetime.datetime.utcfromtimestamp(seconds)
+    if aware:
+        return dt.replace(tzinfo=UTC)
+    return dt
+
+
+def date_number(dt):
+    """
+    Return matplotlib date number of dt, like date2num. Naive
+    datetimes are taken as UTC.
+    """
+    return EPOCH_DATE_NUMBER + (
+        epoch_seconds(dt) + dt.microsecond / 1e6) / SECONDS_PER_DAY
+
+
+def period_index(timestamps, period):
+    """
+    Return for each of timestamps (epoch seconds) the number of the
+    calendar period ('day', 'month', 'quarter', 'year') it is in.
+    Periods are in UTC, like the timestamps.
+    """
+    if period == 'day':
+        return timestamps // SECONDS_PER_DAY
+    if period == 'year':
+        return timestamps.astype('datetime64[s]').astype(
+            'datetime64[Y]').astype(np.int64)
+    months = timestamps.astype('datetime64[s]').astype(
+        'datetime64[M]').astype(np.int64)
+    if period == 'month':
+        return months
+    if period == 'quarter':
+        return months // 3
+    raise ValueError('Unknown period %s' % period)
+
+
+def as_time_series(value):
+    """
+    Return value as TimeSeries if it is a ColumnarSeries, otherwise
+    return it unchanged (numbers, TimeSeries).
+    """
+    if isinstance(value, ColumnarSeries):
+        return value.to_time_series()
+    return value
+
+
+class ColumnarSeries(object):
+    """
+    Time series with its events in (sorted) arrays.
+    """
+    META = ('location_id', 'parameter_id', 'time_step', 'units')
+
+    def __init__(self, timestamps=None, values=None, flags=None,
+                 comments=None, aware=False, is_locf=False, **meta):
+        if timestamps is None:
+            timestamps = np.empty(0, dtype=np.int64)
+        if values is None:
+            values = np.zeros(len(timestamps), dtype=np.float64)
+        if flags is None:
+            flags = np.empty(len(timestamps), dtype=np.int16)
+            flags.fill(NO_FLAG)
+        self.timestamps = timestamps
+        self.values = values
+        self.flags = flags
+        # None if there are no comments at all.
+        self.comments = comments
+        self.aware = aware
+        self.is_locf = is_locf
+        for name in ColumnarSeries.META:
+            setattr(self, name, meta.pop(name, None))
+        if meta:
+            raise TypeError(
+                'Unknown ColumnarSeries field(s): %s' % ', '.join(meta))
+
+    def meta(self):
+        """
+        Return dict with the metadata, to create a similar series.
+        """
+        result = dict([(name, getattr(self, name))
+                       for name in ColumnarSeries.META])
+        result['aware'] = self.aware
+        result['is_locf'] = self.is_locf
+        return result
+
+    @classmethod
+    def from_events(cls, events, **meta):
+        """
+        Return ColumnarSeries from an iterable of (timestamp, value,
+        flag, comment), like the fewsnorm Event objects.
+        """
+        events = list(events)
+        count = len(events)
+        timestamps = np.empty(count, dtype=np.int64)
+        values = np.empty(count, dtype=np.float64)
+        flags = np.empty(count, dtype=np.int16)
+        comments = None
+        aware = meta.pop('aware', False)
+        for index, (timestamp, value, flag, comment) in enumerate(events):
+            if timestamp.tzinfo is not None:
+                aware = True
+            timestamps[index] = epoch_seconds(timestamp)
+            values[index] = np.nan if value is None else value
+            flags[index] = NO_FLAG if flag is None else flag
+            if comment:
+                if comments is None:
+                    comments = np.empty(count, dtype=object)
+                comments[index] = comment
+        return cls(timestamps, values, flags, comments, aware=aware,
+                   **meta)._sorted()
+
+    @classmethod
+    def from_time_series(cls, ts):
+        """
+        Return ColumnarSeries from TimeSeries ts.
+        """
+        result = cls.from_events(
+            [(timestamp, value, flag, comment)
+             for timestamp, (value, flag, comment) in ts.get_events()],
+            **dict([(name, getattr(ts, name, None))
+                    for name in ColumnarSeries.META]))
+        result.is_locf = getattr(ts, 'is_locf', False)
+        return result
+
+    def to_time_series(self):
+        """
+        Return TimeSeries with the same events and metadata.
+        """
+        ts = timeseries.TimeSeries()
+        for name in ColumnarSeries.META:
+            setattr(ts, name, getattr(self, name))
+        ts.is_locf = self.is_locf
+        for timestamp, event in self.get_events():
+            ts[timestamp] = event
+        return ts
+
+    def _sorted(self):
+        """
+        Sort the events by timestamp. Of events with the same timestamp,
+        the last one wins, like with TimeSeries.
+        """
+        timestamps = self.timestamps
+        if len(timestamps) < 2 or (timestamps[1:] > timestamps[:-1]).all():
+            return self
+        order = np.argsort(timestamps, kind='mergesort')
+        timestamps = timestamps[order]
+        keep = np.append(timestamps[1:] != timestamps[:-1], True)
+        order = order[keep]
+        self.timestamps = self.timestamps[order]
+        self.values = self.values[order]
+        self.flags = self.flags[order]
+        if self.comments is not None:
+            self.comments = self.comments[order]
+        return self
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def datetimes(self):
+        """
+        Return list of the timestamps as datetimes.
+        """
+        datetimes = self.timestamps.astype('datetime64[s]').tolist()
+        if self.aware:
+            return [dt.replace(tzinfo=UTC) for dt in datetimes]
+        return datetimes
+
+    def get_events(self):
+        """
+        Return sorted list of (timestamp, (value, flag, comment)), like
+        TimeSeries.get_events.
+        """
+        values = np.where(
+            np.isnan(self.values), None, self.values).tolist()
+        flags = np.where(self.flags == NO_FLAG, None, self.flags).tolist()
+        comments = self.comments
+        if comments is None:
+            comments = [None] * len(self)
+        return zip(self.datetimes(), zip(values, flags, comments))
+
+    def clone(self, with_events=False):
+        """
+        Return copy with the same metadata, with (copies of) the events
+        if with_events.
+        """
+        if not with_events:
+            return ColumnarSeries(**self.meta())
+        return ColumnarSeries(
+            self.timestamps.copy(), self.values.copy(), self.flags.copy(),
+            None if self.comments is None else self.comments.copy(),
+            **self.meta())
+
+    def take(self, selection):
+        """
+        Return series with the events selected by index array, mask or
+        slice. Slices share the arrays.
+        """
+        return ColumnarSeries(
+            self.timestamps[selection], self.values[selection],
+            self.flags[selection],
+            None if self.comments is None else self.comments[selection],
+            **self.meta())
+
+    def window(self, dt_start=None, dt_end=None, include_end=True):
+        """
+        Return series with the events from dt_start up to (and
+        including, if include_end) dt_end. Shares the arrays.
+        """
+        start = 0
+        end = len(self.timestamps)
+        if dt_start is not None:
+            start = np.searchsorted(
+                self.timestamps, epoch_seconds(dt_start), side='left')
+        if dt_end is not None:
+            end = np.searchsorted(
+                self.timestamps, epoch_seconds(dt_end),
+                side='right' if include_end else 'left')
+        return self.take(slice(start, end))
+
+    def sign_part(self, positive):
+        """
+        Return series with only the events with values >= 0 (positive)
+        or the other events (not positive, including missing values).
+        """
+        mask = self.values >= 0
+        if not positive:
+            mask = ~mask
+        return self.take(mask)
+
+    @classmethod
+    def concatenate(cls, series_list):
+        """
+        Return a new series with the events of consecutive,
+        non-overlapping series. Metadata is taken from the first one.
+        """
+        first = series_list[0]
+        comments = None
+        if [series for series in series_list if series.comments is not None]:
+            comments = np.concatenate([
+                    series.comments if series.comments is not None
+                    else np.empty(len(series), dtype=object)
+                    for series in series_list])
+        meta = first.meta()
+        meta['aware'] = bool([series for series in series_list
+                              if series.aware])
+        return cls(
+            np.concatenate([series.timestamps for series in series_list]),
+            np.concatenate([series.values for series in series_list]),
+            np.concatenate([series.flags for series in series_list]),
+            comments, **meta)
+
+    @property
+    def nbytes(self):
+        result = (self.timestamps.nbytes + self.values.nbytes +
+                  self.flags.nbytes)
+        if self.comments is not None:
+            result += self.comments.nbytes
+        return result
+
+    def cumulative(self, reset_period, in_place=False):
+        """
+        Return cumulative sum of the values, restarting at every
+        reset_period ('day', 'month', 'quarter', 'year'). If in_place,
+        the values of this series are replaced, otherwise a copy is
+        returned.
+        """
+        result = self if in_place else self.clone(with_events=True)
+        if not len(result):
+            return result
+        groups = period_index(result.timestamps, reset_period)
+        starts = np.concatenate(
+            ([0], np.flatnonzero(groups[1:] != groups[:-1]) + 1,
+             [len(groups)]))
+        values = result.values
+        for start, end in zip(starts[:-1], starts[1:]):
+            np.cumsum(values[start:end], out=values[start:end])
+        return result
+
+    def values_at(self, timestamps):
+        """
+        Return values at timestamps (epoch seconds, sorted). Where this
+        series has no event, the value is the last observation before
+        it if is_locf (0 before the first one), otherwise 0.
+        """
+        result = np.zeros(len(timestamps), dtype=np.float64)
+        if not len(self.timestamps):
+            return result
+        index = np.searchsorted(self.timestamps, timestamps, side='right') - 1
+        known = index >= 0
+        if not self.is_locf:
+            known &= self.timestamps[np.maximum(index, 0)] == timestamps
+        result[known] = self.values[index[known]]
+        return result
+
+    def _binary(self, other, operation):
+        if not isinstance(other, ColumnarSeries):
+            # A number.
+            return ColumnarSeries(
+                self.timestamps, operation(self.values, other), self.flags,
+                self.comments, **self.meta())
+
+        timestamps = np.union1d(self.timestamps, other.timestamps)
+        values = operation(
+            self.values_at(timestamps), other.values_at(timestamps))
+
+        # Flags and comments of self, where self has no event those of
+        # other.
+        flags = np.empty(len(timestamps), dtype=np.int16)
+        flags.fill(NO_FLAG)
+        comments = None
+        if self.comments is not None or other.comments is not None:
+            comments = np.empty(len(timestamps), dtype=object)
+        for series in (other, self):
+            index = np.searchsorted(timestamps, series.timestamps)
+            flags[index] = series.flags
+            if series.comments is not None:
+                comments[index] = series.comments
+
+        meta = self.meta()
+        meta['aware'] = self.aware or other.aware
+        meta['is_locf'] = self.is_locf or other.is_locf
+        return ColumnarSeries(timestamps, values, flags, comments, **meta)
+
+    def __add__(self, other):
+        return self._binary(other, np.add)
+
+    def __radd__(self, other):
+        return self._binary(other, lambda a, b: np.add(b, a))
+
+    def __sub__(self, other):
+        return self._binary(other, np.subtract)
+
+    def __rsub__(self, other):
+        return self._binary(other, lambda a, b: np.subtract(b, a))
+
+    def __mul__(self, other):
+        return self._binary(other, np.multiply)
+
+    def __rmul__(self, other):
+        return self._binary(other, lambda a, b: np.multiply(b, a))
+
+    def __neg__(self):
+        return self * -1
+
+    def __abs__(self):
+        return ColumnarSeries(
+            self.timestamps, np.abs(self.values), self.flags,
+            self.comments, **self.meta())
@@ -0,0 +1,80 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Downsampling of line series to the width of the graph.
+
+A line of 100k events in a 1200 pixel wide graph draws about 80
+events per pixel column. Per pixel column, only the first, last,
+lowest and highest event (M4) determine what the line looks like, so
+the other events are left out. Optionally flagged events are kept as
+well, so they can still be marked.
+"""
+import numpy as np
+
+from lizard_graph.columnar import NO_FLAG
+from lizard_graph.columnar import epoch_seconds
+
+
+# Events kept per pixel column: first, last, lowest and highest.
+POINTS_PER_PIXEL = 4
+
+
+def _first_per_group(indices, groups):
+    """
+    Return the first of indices per group (groups[indices]).
+    """
+    unused, first = np.unique(groups[indices], return_index=True)
+    return indices[first]
+
+
+def downsample_indices(timestamps, values, start, end, width):
+    """
+    Return sorted indices of the events to keep of the line with
+    timestamps (epoch seconds, sorted) and values, drawn from start to
+    end (epoch seconds) over width pixels.
+
+    Of every pixel column the first, last, lowest and highest event is
+    kept, and the first missing (NaN) value, which breaks the line.
+    Events outside start..end fall in the outer columns.
+    """
+    count = len(timestamps)
+    if count <= POINTS_PER_PIXEL * width or end <= start:
+        return np.arange(count)
+
+    columns = ((timestamps - start) * width) // (end - start)
+    columns = np.clip(columns, 0, width - 1)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(columns)) + 1))
+    ends = np.append(starts[1:], count)
+    groups = np.repeat(np.arange(len(starts)), ends - starts)
+
+    missing = np.isnan(values)
+    low = np.where(missing, np.inf, values)
+    high = np.where(missing, -np.inf, values)
+    lowest = low == np.repeat(np.minimum.reduceat(low, starts), ends - starts)
+    highest = high == np.repeat(
+        np.maximum.reduceat(high, starts), ends - starts)
+
+    keep = np.concatenate((
+            starts, ends - 1,
+            _first_per_group(np.flatnonzero(lowest), groups),
+            _first_per_group(np.flatnonzero(highest), groups),
+            _first_per_group(np.flatnonzero(missing), groups)))
+    return np.unique(keep)
+
+
+def downsample(series, dt_start, dt_end, width, keep_flagged=False):
+    """
+    Return ColumnarSeries series reduced to at most about
+    POINTS_PER_PIXEL events per pixel of width, see downsample_indices.
+
+    If keep_flagged, events with a flag other than 0 are kept as well.
+    """
+    indices = downsample_indices(
+        series.timestamps, series.values,
+        epoch_seconds(dt_start), epoch_seconds(dt_end), width)
+    if len(indices) == len(series):
+        return series
+    if keep_flagged:
+        flagged = np.flatnonzero(
+            (series.flags != NO_FLAG) & (series.flags != 0))
+        indices = np.union1d(indices, flagged)
+    return series.take(indices)
@@ -0,0 +1,496 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Bulk fetching of fewsnorm data for all graph items of a request.
+
+Fetching series and events one graph item at a time costs a database
+round trip per item. The functions and classes in here group the
+graph items by fews_norm_source and run a single query per source
+instead.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from lizard_fewsnorm.models import Location
+from lizard_fewsnorm.models import Series
+
+from lizard_graph.columnar import ColumnarSeries
+
+
+logger = logging.getLogger(__name__)
+
+
+# Series params that identify a series, in the order of the query.
+SERIES_PARAM_KEYS = (
+    'location', 'parameter', 'moduleinstance', 'timestep', 'qualifierset')
+
+# Same attributes as the lizard_fewsnorm Event objects.
+EventRow = namedtuple('EventRow', 'timestamp value flag comment')
+
+# Allowed values for the aggregated events query.
+AGGREGATION_FUNCTIONS = {
+    'avg': 'AVG',
+    'sum': 'SUM',
+    }
+AGGREGATION_PERIODS = ('day', 'month', 'quarter', 'year')
+
+# Columns of the locations table that hold related location idents.
+RELATED_LOCATION_COLUMNS = (
+    'l_esf2', 'l_zicht', 'l_extin', 'l_wathte', 'l_kwel', 'l_wegz',
+    'l_chlor', 'l_oppq', 'l_grq', 'l_stovq', 'l_debiet', 'l_gebied')
+
+# Seconds that the related locations of a source are kept.
+RELATED_LOCATIONS_TIMEOUT = getattr(
+    settings, 'LIZARD_GRAPH_RELATED_LOCATIONS_TIMEOUT', 60 * 60)
+
+RELATED_LOCATIONS_KEY = 'lizard_graph::related_locations::%s'
+
+
+def table_name(source, table):
+    """
+    Return (schema prefixed) name of fewsnorm table.
+    """
+    if source.database_schema_name:
+        return '%s.%s' % (source.database_schema_name, table)
+    return table
+
+
+def series_query(source, series_params_list):
+    """
+    Return query and params that select all series matching any of
+    the provided series params in one go.
+
+    The selected columns are the same as Series.from_raw, so the
+    resulting objects can be used by Event.time_series and
+    Event.agg_from_raw.
+    """
+    tables = dict(
+        [(table, table_name(source, table)) for table in (
+                'timeserieskeys', 'locations', 'parameterstable',
+                'moduleinstances', 'timesteps', 'qualifiersets')])
+    columns = {
+        'location': 'l.id',
+        'parameter': 'p.id',
+        'moduleinstance': 'm.id',
+        'timestep': 't.id',
+        'qualifierset': 'q.id',
+        }
+    conditions = []
+    params = []
+    for series_params in series_params_list:
+        condition = []
+        for key in SERIES_PARAM_KEYS:
+            if key in series_params:
+                condition.append('%s = %%s' % columns[key])
+                params.append(series_params[key])
+        if condition:
+            conditions.append('(%s)' % ' AND '.join(condition))
+    query = """
+        SELECT ts.serieskey, l.id AS location, p.id AS parameter,
+               m.id AS moduleinstance, t.id AS timestep,
+               q.id AS qualifierset, p.unit AS unit
+        FROM %(timeserieskeys)s ts
+        JOIN %(locations)s l ON ts.locationkey = l.locationkey
+        JOIN %(parameterstable)s p ON ts.parameterkey = p.parameterkey
+        JOIN %(moduleinstances)s m
+          ON ts.moduleinstancekey = m.moduleinstancekey
+        JOIN %(timesteps)s t ON ts.timestepkey = t.timestepkey
+        LEFT OUTER JOIN %(qualifiersets)s q
+          ON ts.qualifiersetkey = q.qualifiersetkey
+        """ % tables
+    if conditions:
+        query += 'WHERE %s' % ' OR '.join(conditions)
+    return query, params
+
+
+def series_matches(single_series, series_params):
+    """
+    Return True if single_series matches all provided series params.
+    """
+    for key in SERIES_PARAM_KEYS:
+        if (key in series_params and
+            getattr(single_series, key, None) != series_params[key]):
+            return False
+    return True
+
+
+class SeriesResolver(object):
+    """
+    Resolve the series of a list of graph items, one query per
+    fews_norm_source.
+
+    Resolving is lazy: the first time the series of a graph item are
+    asked for, the series of all graph items with the same source are
+    fetched in a single query. The data watermarks need the series of
+    every graph item, so in practice every request resolves all series
+    once per source, even when all data comes from the cache.
+    """
+    def __init__(self, graph_items):
+        self.graph_items = list(graph_items)
+        # id(graph_item) -> list of series
+        self._series = {}
+
+    def series(self, graph_item):
+        """
+        Return list of series for graph_item.
+        """
+        if id(graph_item) not in self._series:
+            self._resolve(graph_item.fews_norm_source)
+        # Not resolved items (i.e. not in self.graph_items): resolve
+        # them the old fashioned way.
+        if id(graph_item) not in self._series:
+            self._series[id(graph_item)] = list(graph_item.series())
+        return self._series[id(graph_item)]
+
+    def _resolve(self, source):
+        """
+        Fetch series for all graph items of source.
+        """
+        if source is None:
+            return
+        wanted = []  # (graph_item, series_params)
+        for graph_item in self.graph_items:
+            if id(graph_item) in self._series:
+                continue
+            item_source = graph_item.fews_norm_source
+            if (item_source is None or
+                item_source.database_name != source.database_name):
+                continue
+            try:
+                series_params = graph_item.series_params()
+            except:
+                logger.exception(
+                    "Could not determine series params of %s" % graph_item)
+                self._series[id(graph_item)] = []
+                continue
+            if not series_params:
+                self._series[id(graph_item)] = []
+                continue
+            wanted.append((graph_item, series_params))
+        if not wanted:
+            return
+
+        query, params = series_query(
+            source, [item_params for unused, item_params in wanted])
+        all_series = list(
+            Series.objects.raw(query, params).using(source.database_name))
+        for graph_item, series_params in wanted:
+            self._series[id(graph_item)] = [
+                single_series for single_series in all_series
+                if series_matches(single_series, series_params)]
+
+
+def events_query(source, serieskeys, dt_start, dt_end):
+    """
+    Return query and params that select the events, including
+    comments, of all provided series from dt_start up to (not
+    including) dt_end.
+
+    Rows are (serieskey, timestamp, value, flag, comment), ordered by
+    serieskey and timestamp.
+    """
+    query = """
+        SELECT v.serieskey, v.datetime, v.scalarvalue, v.flags, c.comments
+        FROM %(values)s v
+        LEFT OUTER JOIN %(comments)s c
+          ON v.serieskey = c.serieskey AND v.datetime = c.datetime
+        WHERE v.serieskey IN (%(serieskeys)s)
+          AND v.datetime >= %%s AND v.datetime < %%s
+        ORDER BY v.serieskey, v.datetime
+        """ % {
+        'values': table_name(source, 'timeseriesvaluesandflags'),
+        'comments': table_name(source, 'timeseriescomments'),
+        'serieskeys': ', '.join(['%s'] * len(serieskeys)),
+        }
+    return query, list(serieskeys) + [dt_start, dt_end]
+
+
+def aggregated_events_query(source, serieskeys, dt_start, dt_end,
+                            aggregation, aggregation_period):
+    """
+    Return query and params that select the aggregated events of all
+    provided series from dt_start up to (not including) dt_end. Use
+    whole aggregation periods to get complete aggregates.
+
+    Rows are (serieskey, timestamp, value, flag, comment), ordered by
+    serieskey and timestamp. The timestamp is the start of the period.
+    """
+    if aggregation_period not in AGGREGATION_PERIODS:
+        raise ValueError(
+            'Unknown aggregation period %s' % aggregation_period)
+    query = """
+        SELECT serieskey, date_trunc('%(period)s', datetime),
+               %(function)s(scalarvalue), MAX(flags), NULL
+        FROM %(values)s
+        WHERE serieskey IN (%(serieskeys)s)
+          AND datetime >= %%s AND datetime < %%s
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        """ % {
+        'period': aggregation_period,
+        'function': AGGREGATION_FUNCTIONS[aggregation],
+        'values': table_name(source, 'timeseriesvaluesandflags'),
+        'serieskeys': ', '.join(['%s'] * len(serieskeys)),
+        }
+    return query, list(serieskeys) + [dt_start, dt_end]
+
+
+def events_by_serieskey(source, query, params):
+    """
+    Run events query on source, return dict serieskey -> [EventRow].
+    """
+    result = {}
+    cursor = connections[source.database_name].cursor()
+    cursor.execute(query, params)
+    for serieskey, timestamp, value, flag, comment in cursor.fetchall():
+        result.setdefault(serieskey, []).append(
+            EventRow(timestamp, value, flag, comment))
+    return result
+
+
+def _graph_items_by_source(graph_items):
+    """
+    Return dict database_name -> (source, [graph_item, ...]).
+    """
+    result = {}
+    for graph_item in graph_items:
+        source = graph_item.fews_norm_source
+        if source is None:
+            continue
+        result.setdefault(
+            source.database_name, (source, []))[1].append(graph_item)
+    return result
+
+
+def watermarks_query(source, serieskeys, chunks):
+    """
+    Return query and params that select the watermark of all provided
+    series per chunk.
+
+    chunks is a list of (chunk_start, chunk_end). Rows are (serieskey,
+    chunk index, number of events, latest event timestamp). Chunks
+    without events are left out.
+
+    The query runs on every request, so it only uses what an index on
+    (serieskey, datetime) can answer. Corrections of existing events
+    do not change the watermark: they show up when the cached chunk
+    expires (LIZARD_GRAPH_TIME_SERIES_CACHE_TIMEOUT).
+    """
+    chunk_values = []
+    params = []
+    for index, (chunk_start, chunk_end) in enumerate(chunks):
+        chunk_values.append('(%s, %%s, %%s)' % index)
+        params.extend([chunk_start, chunk_end])
+    query = """
+        SELECT v.serieskey, c.chunk, COUNT(*), MAX(v.datetime)
+        FROM %(values)s v
+        JOIN (VALUES %(chunks)s) AS c (chunk, chunk_start, chunk_end)
+          ON v.datetime >= c.chunk_start AND v.datetime < c.chunk_end
+        WHERE v.serieskey IN (%(serieskeys)s)
+        GROUP BY 1, 2
+        """ % {
+        'values': table_name(source, 'timeseriesvaluesandflags'),
+        'chunks': ', '.join(chunk_values),
+        'serieskeys': ', '.join(['%s'] * len(serieskeys)),
+        }
+    return query, params + list(serieskeys)
+
+
+def watermarks_by_serieskey(source, query, params):
+    """
+    Run watermarks query on source, return dict (serieskey, chunk
+    index) -> (number of events, latest event timestamp).
+    """
+    result = {}
+    cursor = connections[source.database_name].cursor()
+    cursor.execute(query, params)
+    for serieskey, chunk, count, latest in cursor.fetchall():
+        result[serieskey, chunk] = (count, latest)
+    return result
+
+
+def related_locations_query(source):
+    """
+    Return query and params that select the related locations of all
+    locations of source.
+    """
+    query = 'SELECT id, %s FROM %s' % (
+        ', '.join(RELATED_LOCATION_COLUMNS), table_name(source, 'locations'))
+    return query, []
+
+
+# Related locations that are used in this process: database name ->
+# (expires, related locations).
+_related_locations = {}
+_related_locations_lock = threading.Lock()
+
+
+def related_locations(source):
+    """
+    Return dict location ident -> tuple of related location idents
+    (see RELATED_LOCATION_COLUMNS) of source.
+
+    The result is fetched with one query and kept in the cache and in
+    this process for RELATED_LOCATIONS_TIMEOUT seconds.
+    """
+    now = time.time()
+    local = _related_locations.get(source.database_name)
+    if local is not None and local[0] > now:
+        return local[1]
+
+    with _related_locations_lock:
+        local = _related_locations.get(source.database_name)
+        if local is not None and local[0] > now:
+            return local[1]
+        key = RELATED_LOCATIONS_KEY % source.database_name
+        result = cache.get(key)
+        if result is None:
+            query, params = related_locations_query(source)
+            cursor = connections[source.database_name].cursor()
+            cursor.execute(query, params)
+            result = dict([(row[0], tuple(row[1:]))
+                           for row in cursor.fetchall()])
+            cache.set(key, result, RELATED_LOCATIONS_TIMEOUT)
+        _related_locations[source.database_name] = (
+            now + RELATED_LOCATIONS_TIMEOUT, result)
+    return result
+
+
+def related_location(source, ident, column):
+    """
+    Return ident of the location in column (one of
+    RELATED_LOCATION_COLUMNS) of location ident.
+    """
+    try:
+        return related_locations(source)[ident][
+            RELATED_LOCATION_COLUMNS.index(column)]
+    except KeyError:
+        # Unknown location, maybe added after the related locations
+        # were fetched.
+        fews_location = Location.from_raw(
+            schema_prefix=source.database_schema_name,
+            ident=ident,
+            related_location=column).using(source.database_name)[0]
+        return fews_location.related_location
+
+
+def _fetch_bulk(graph_items, series_resolver, fetch_source, make_result):
+    """
+    Fetch data for graph_items, one query per source.
+
+    fetch_source(source, serieskeys) returns the data of a source,
+    make_result(graph_item, series, data) returns the result for a
+    single graph item.
+
+    Returns dict id(graph_item) -> result. Graph items that could not
+    be fetched are left out.
+    """
+    result = {}
+    for source, source_graph_items in _graph_items_by_source(
+        graph_items).values():
+        try:
+            item_series = [
+                (graph_item, series_resolver.series(graph_item))
+                for graph_item in source_graph_items]
+            serieskeys = set()
+            for graph_item, series in item_series:
+                serieskeys.update(
+                    [single_series.pk for single_series in series])
+            data = {}
+            if serieskeys:
+                data = fetch_source(source, sorted(serieskeys))
+            for graph_item, series in item_series:
+                result[id(graph_item)] = make_result(
+                    graph_item, series, data)
+        except:
+            logger.exception(
+                "Error fetching data from %s" % source.database_name)
+    return result
+
+
+def time_series_bulk(graph_items, dt_start, dt_end, series_resolver):
+    """
+    Bulk version of GraphItemMixin.time_series.
+
+    Returns dict id(graph_item) -> {(location, parameter, unit):
+    ColumnarSeries}, with a single events query per fews_norm_source.
+    """
+    def fetch_source(source, serieskeys):
+        query, params = events_query(source, serieskeys, dt_start, dt_end)
+        return events_by_serieskey(source, query, params)
+
+    def make_result(graph_item, series, events):
+        result = {}
+        for single_series in series:
+            ts = ColumnarSeries.from_events(
+                [(event.timestamp, event.value, event.flag, event.comment)
+                 for event in events.get(single_series.pk, [])],
+                location_id=single_series.location,
+                parameter_id=single_series.parameter,
+                time_step=single_series.timestep,
+                units=single_series.unit)
+            result[single_series.location, single_series.parameter,
+                   single_series.unit] = ts
+        return result
+
+    return _fetch_bulk(
+        graph_items, series_resolver, fetch_source, make_result)
+
+
+def time_series_aggregated_bulk(graph_items, aggregation, aggregation_period,
+                                dt_start, dt_end, series_resolver):
+    """
+    Bulk version of GraphItemMixin.time_series_aggregated.
+
+    Returns dict id(graph_item) -> {(location, parameter,
+    TIME_SERIES_ALL): ColumnarSeries}, with a single events query per
+    fews_norm_source. See spec.sign_split for the positive and negative
+    parts.
+    """
+    def fetch_source(source, serieskeys):
+        query, params = aggregated_events_query(
+            source, serieskeys, dt_start, dt_end,
+            aggregation, aggregation_period)
+        return events_by_serieskey(source, query, params)
+
+    def make_result(graph_item, series, events):
+        result = {}
+        for single_series in series:
+            result.update(graph_item.aggregated_time_series_from_events(
+                    single_series, events.get(single_series.pk, [])))
+        return result
+
+    return _fetch_bulk(
+        graph_items, series_resolver, fetch_source, make_result)
+
+
+def watermarks_bulk(graph_items, chunks, series_resolver):
+    """
+    Return the data watermarks of graph_items, with a single query per
+    fews_norm_source.
+
+    Returns dict id(graph_item) -> list with a watermark per chunk. A
+    watermark is a tuple of (serieskey, number of events, latest event
+    timestamp) for all series of the graph item. When events of a
+    series are added or removed, its watermark changes.
+    """
+    def fetch_source(source, serieskeys):
+        query, params = watermarks_query(source, serieskeys, chunks)
+        return watermarks_by_serieskey(source, query, params)
+
+    def make_result(graph_item, series, watermarks):
+        serieskeys = sorted(
+            [single_series.pk for single_series in series])
+        return [
+            tuple([(serieskey, ) + watermarks.get(
+                        (serieskey, index), (0, None))
+                   for serieskey in serieskeys])
+            for index in range(len(chunks))]
+
+    return _fetch_bulk(
+        graph_items, series_resolver, fetch_source, make_result)
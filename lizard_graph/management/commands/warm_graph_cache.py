@@ -0,0 +1,177 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Warm the cache for predefined graphs, so the first user after a FEWS
+import does not have to wait for a cold cache.
+
+By default only the time series of the graphs are fetched into the
+cache, in parallel. With --render the graphs are rendered as well,
+one at a time (matplotlib is not thread safe). The graphs are requested
+through GraphView, exactly like the url ?graph=<slug>&location=<ident>
+would be.
+"""
+from optparse import make_option
+import Queue
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connections
+from django.test.client import RequestFactory
+
+from lizard_graph.caching import render_cache_key
+from lizard_graph.models import PredefinedGraph
+from lizard_graph.views import GraphView
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = '[<predefined graph slug> ...]'
+    help = ('Fetch the time series of predefined graphs into the cache. '
+            'Without slugs, all predefined graphs are warmed.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--location',
+                    action='append',
+                    dest='locations',
+                    default=[],
+                    help='Location ident, can be given multiple times.'),
+        make_option('--param',
+                    action='append',
+                    dest='params',
+                    default=[],
+                    help=('Extra url parameter key=value, like '
+                          'width=800. Can be given multiple times.')),
+        make_option('--parallel',
+                    type='int',
+                    dest='parallel',
+                    default=4,
+                    help=('Number of graphs fetched at the same time. '
+                          'Graphs are rendered one at a time.')),
+        make_option('--render',
+                    action='store_true',
+                    dest='render',
+                    default=False,
+                    help='Render the graphs as well.'),
+        make_option('--force',
+                    action='store_true',
+                    dest='force',
+                    default=False,
+                    help=('With --render, re-render graphs that are in the '
+                          'cache already.')),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            slugs = list(args)
+            existing = set(PredefinedGraph.objects.filter(
+                    slug__in=slugs).values_list('slug', flat=True))
+            unknown = [slug for slug in slugs if slug not in existing]
+            if unknown:
+                raise CommandError(
+                    'Unknown predefined graph(s): %s' % ', '.join(unknown))
+        else:
+            slugs = list(PredefinedGraph.objects.values_list(
+                    'slug', flat=True))
+
+        params = []
+        for param in options['params']:
+            if '=' not in param:
+                raise CommandError('Expected key=value, got %s' % param)
+            params.append(tuple(param.split('=', 1)))
+
+        jobs = Queue.Queue()
+        for slug in slugs:
+            for location in options['locations'] or [None]:
+                jobs.put((slug, location))
+        job_count = jobs.qsize()
+
+        self.output_lock = threading.Lock()
+        self.failures = 0
+        started = time.time()
+        # Matplotlib is not thread safe: render one graph at a time.
+        parallel = 1 if options['render'] else options['parallel']
+        workers = [
+            threading.Thread(
+                target=self.worker,
+                args=(jobs, params, options['render'], options['force']))
+            for _ in range(max(1, min(parallel, job_count)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.stdout.write('Warmed %d graph(s) in %.2f s, %d failed.\n' % (
+                job_count, time.time() - started, self.failures))
+
+    def worker(self, jobs, params, render, force):
+        try:
+            while True:
+                try:
+                    slug, location = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                self.warm(slug, location, params, render, force)
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    def warm(self, slug, location, params, render, force):
+        get = [('graph', slug)]
+        if location is not None:
+            get.append(('location', location))
+        get.extend(params)
+        request = RequestFactory().get('/', get)
+        label = slug if location is None else '%s %s' % (slug, location)
+
+        started = time.time()
+        try:
+            if render:
+                result = self.render(request, force)
+            else:
+                result = self.fetch(request)
+        except:
+            logger.exception('Error warming graph %s' % label)
+            result = 'error'
+        seconds = time.time() - started
+
+        with self.output_lock:
+            if result == 'error':
+                self.failures += 1
+            self.stdout.write('%s: %.2f s (%s)\n' % (label, seconds, result))
+
+    def render(self, request, force):
+        """
+        Render the graph through GraphView.get, which puts the graph
+        and its time series in the cache.
+
+        The default time window moves every minute, so a rendered graph
+        is only reused by other requests with the same explicit
+        dt_start and dt_end (--param).
+        """
+        if force:
+            graph_view = GraphView(request=request)
+            dt_start, dt_end = graph_view._dt_from_request()
+            cache.delete(render_cache_key(request.GET, dt_start, dt_end))
+        response = GraphView.as_view()(request)
+        return response.status_code
+
+    def fetch(self, request):
+        """
+        Only put the time series of the graph in the cache.
+        """
+        graph_view = GraphView(request=request)
+        dt_start, dt_end = graph_view._dt_from_request()
+        stale_after, expire_after = graph_view._cache_policy()
+        graph_items, graph_settings = graph_view._graph_items_from_request()
+        time_series, complete = graph_view.fetch_time_series(
+            graph_items, graph_settings, dt_start, dt_end,
+            expire_after=expire_after)
+        if not complete:
+            return 'error'
+        return '%d time series' % sum(
+            [len(ts) for ts in time_series.values()])
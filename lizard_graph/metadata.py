@@ -0,0 +1,136 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+In-memory index of the fewsnorm metadata tables.
+
+GeoLocationCache, ParameterCache, ModuleCache, TimeStepCache and
+QualifierSetCache only change when sync_fewsnorm runs. Each process
+loads a table once, on first use, and looks up objects by pk or ident
+from then on.
+
+A generation counter in the Django cache tells the processes to reload
+the tables. It is bumped on every save or delete of one of the models;
+call bump_metadata_generation after changing the tables in another way
+(raw SQL, another application).
+
+The objects in the index are shared: treat them as read-only.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from lizard_fewsnorm.models import GeoLocationCache
+from lizard_fewsnorm.models import ModuleCache
+from lizard_fewsnorm.models import ParameterCache
+from lizard_fewsnorm.models import QualifierSetCache
+from lizard_fewsnorm.models import TimeStepCache
+
+
+logger = logging.getLogger(__name__)
+
+
+METADATA_MODELS = (GeoLocationCache, ParameterCache, ModuleCache,
+                   TimeStepCache, QualifierSetCache)
+
+# Seconds between checks of the generation counter.
+CHECK_INTERVAL = getattr(
+    settings, 'LIZARD_GRAPH_METADATA_CHECK_INTERVAL', 10)
+
+GENERATION_KEY = 'lizard_graph::metadata_generation'
+
+
+def metadata_generation():
+    """
+    Return the current generation of the metadata tables.
+    """
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Unknown (i.e. expired): start a new, unique generation.
+        generation = int(time.time() * 1000)
+        cache.add(GENERATION_KEY, generation)
+        generation = cache.get(GENERATION_KEY, generation)
+    return generation
+
+
+def bump_metadata_generation(**kwargs):
+    """
+    Signal handler: the metadata tables have changed.
+    """
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # Key does not exist: the next metadata_generation call starts
+        # a new one.
+        pass
+    metadata.clear()
+
+
+class MetadataIndex(object):
+    """
+    Index of the METADATA_MODELS tables by pk and by ident.
+    """
+    def __init__(self, check_interval=CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # model -> (objects, by_pk, by_ident)
+        self.tables = {}
+        self.generation = None
+        self.checked = 0
+
+    def _check_generation(self):
+        now = time.time()
+        if now - self.checked < self.check_interval:
+            return
+        generation = metadata_generation()
+        if generation != self.generation:
+            self.tables = {}
+            self.generation = generation
+        self.checked = now
+
+    def _load(self, model):
+        queryset = model.objects.all()
+        if model is GeoLocationCache:
+            queryset = queryset.select_related('fews_norm_source')
+        objects = list(queryset)
+        by_pk = dict([(obj.pk, obj) for obj in objects])
+        by_ident = {}
+        for obj in objects:
+            # If an ident occurs more than once, just take one.
+            by_ident.setdefault(obj.ident, obj)
+        logger.debug("Loaded %d %s objects" % (len(objects), model.__name__))
+        return objects, by_pk, by_ident
+
+    def _table(self, model):
+        self._check_generation()
+        table = self.tables.get(model)
+        if table is None:
+            with self.lock:
+                table = self.tables.get(model)
+                if table is None:
+                    table = self._load(model)
+                    self.tables[model] = table
+        return table
+
+    def all(self, model):
+        """
+        Return list of all objects of model.
+        """
+        return self._table(model)[0]
+
+    def get(self, model, pk=None, ident=None):
+        """
+        Return object of model by pk or ident, None if it does not
+        exist.
+        """
+        objects, by_pk, by_ident = self._table(model)
+        if pk is not None:
+            return by_pk.get(pk)
+        return by_ident.get(ident)
+
+
+metadata = MetadataIndex()
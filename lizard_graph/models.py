@@ -1,5 +1,8 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
 
 from lizard_fewsnorm.models import GeoLocationCache
 from lizard_fewsnorm.models import ModuleCache
@@ -9,10 +12,18 @@ from lizard_fewsnorm.models import TimeStepCache
 
 from lizard_map.models import ColorField
 
-from lizard_fewsnorm.models import Event
-from lizard_fewsnorm.models import Location
-from lizard_fewsnorm.models import Series
-from timeseries import timeseries
+from lizard_graph.caching import bump_definitions_version
+from lizard_graph.caching import definitions_version
+from lizard_graph.fetch import RELATED_LOCATION_COLUMNS
+from lizard_graph.metadata import METADATA_MODELS
+from lizard_graph.metadata import bump_metadata_generation
+from lizard_graph.metadata import metadata
+from lizard_graph.spec import GraphItemSpec
+from lizard_graph.spec import LAYOUT_FIELDS
+from lizard_graph.spec import TIME_SERIES_ALL
+from lizard_graph.spec import TIME_SERIES_NEGATIVE
+from lizard_graph.spec import TIME_SERIES_POSITIVE
+from lizard_graph.spec import layout_as_dict
 
 import logging
 
@@ -98,6 +109,21 @@ class PredefinedGraph(models.Model):
     reset_period = models.IntegerField(
         choices=PERIOD_CHOICES, null=True, blank=True,
         help_text=('For stacked-line-cumulative'))
+    stack_grid_step = models.IntegerField(
+        null=True, blank=True,
+        help_text=('For stacked-line and stacked-line-cumulative: seconds '
+                   'between the points of a common time grid. Empty: '
+                   'stack on the exact timestamps'))
+
+    cache_stale_after = models.IntegerField(
+        null=True, blank=True,
+        help_text=('Seconds after which a cached graph is refreshed in the '
+                   'background. Until then, the cached graph is shown'))
+    cache_expire_after = models.IntegerField(
+        null=True, blank=True,
+        help_text=('Seconds after which a cached graph is not shown '
+                   'anymore. Also enables showing cached data while '
+                   'changed data is fetched in the background'))
 
     def __unicode__(self):
         return self.name
@@ -105,10 +131,62 @@ class PredefinedGraph(models.Model):
     def unfolded_graph_items(self, location=None):
         """
         Graph items can point to other predefined graphs, this unfolds it.
+
+        The result consists of unsaved copies of the graph items. The
+        whole tree is loaded with a constant number of queries per
+        nesting level.
         """
+        return self._unfold(
+            self.slug, self._graph_items_by_slug(), location, (self.slug, ))
+
+    def _graph_items_by_slug(self):
+        """
+        Return dict slug -> graph items of this and all nested
+        predefined graphs.
+        """
+        result = {}
+        slug_by_id = {self.id: self.slug}
+        while slug_by_id:
+            for slug in slug_by_id.values():
+                result[slug] = []
+            nested_slugs = set()
+            graph_items = GraphItem.objects.filter(
+                predefined_graph__in=slug_by_id.keys())
+            for graph_item in graph_items:
+                result[slug_by_id[graph_item.predefined_graph_id]].append(
+                    graph_item)
+                if (graph_item.graph_type ==
+                    GraphItem.GRAPH_TYPE_PREDEFINED_GRAPH and
+                    graph_item.value not in result):
+                    nested_slugs.add(graph_item.value)
+            slug_by_id = {}
+            if nested_slugs:
+                slug_by_id = dict(PredefinedGraph.objects.filter(
+                        slug__in=nested_slugs).values_list('id', 'slug'))
+        return result
+
+    @classmethod
+    def _unfold(cls, slug, graph_items_by_slug, location, parents):
         result = []
-        for graph_item in self.graphitem_set.all():
-            new_graph_items = graph_item.from_dict(graph_item.as_dict())
+        for graph_item in graph_items_by_slug[slug]:
+            if graph_item.graph_type == GraphItem.GRAPH_TYPE_PREDEFINED_GRAPH:
+                nested_slug = graph_item.value
+                if nested_slug not in graph_items_by_slug:
+                    logger.error("Tried to fetch a non-existing predefined "
+                                 "graph %s" % nested_slug)
+                    continue
+                if nested_slug in parents:
+                    logger.error("Predefined graph %s contains itself" %
+                                 nested_slug)
+                    continue
+                # The location comes from the metadata index, not from
+                # a query per nested graph.
+                new_graph_items = cls._unfold(
+                    nested_slug, graph_items_by_slug,
+                    graph_item._related('location', GeoLocationCache),
+                    parents + (nested_slug, ))
+            else:
+                new_graph_items = [graph_item.memory_copy()]
             # Add location if it is not already defined.
             if location is not None:
                 for new_graph_item in new_graph_items:
@@ -142,6 +220,8 @@ class PredefinedGraph(models.Model):
                 self.aggregation_period]
         if self.reset_period:
             result['reset-period'] = PredefinedGraph.PERIOD[self.reset_period]
+        if self.stack_grid_step:
+            result['stack-grid-step'] = self.stack_grid_step
         return result
 
     def natural_key(self):
@@ -182,38 +262,15 @@ class GraphLayoutMixin(models.Model):
             self.label = layout_dict['label']
 
     def layout_as_dict(self):
-        result = {}
-        if self.color:
-            result['color'] = self.color
-        if self.color_outside:
-            result['color-outside'] = self.color_outside
-        if self.line_width:
-            result['line-width'] = self.line_width
-        if self.line_style:
-            result['line-style'] = self.line_style
-        if self.label:
-            result['label'] = self.label
-        return result
+        return layout_as_dict(self)
 
 
 class GraphItemMixin(models.Model):
     """
     About location, parameter and modules and fetching timeseries.
     """
-    RELATED_LOCATION_CHOICES = (
-        ('l_esf2', 'l_esf2'),
-        ('l_zicht', 'l_zicht'),
-        ('l_extin', 'l_extin'),
-        ('l_wathte', 'l_wathte'),
-        ('l_kwel', 'l_kwel'),
-        ('l_wegz', 'l_wegz'),
-        ('l_chlor', 'l_chlor'),
-        ('l_oppq', 'l_oppq'),
-        ('l_grq', 'l_grq'),
-        ('l_stovq', 'l_stovq'),
-        ('l_debiet', 'l_debiet'),
-        ('l_gebied', 'l_gebied'),
-        )
+    RELATED_LOCATION_CHOICES = tuple(
+        [(column, column) for column in RELATED_LOCATION_COLUMNS])
 
     location = models.ForeignKey(
         GeoLocationCache, null=True, blank=True,
@@ -246,143 +303,87 @@ class GraphItemMixin(models.Model):
                    'from this related_location column'))
 
     # Used by time_series_aggregated to 'flag' a time series.
-    TIME_SERIES_ALL = 1
-    TIME_SERIES_POSITIVE = 2
-    TIME_SERIES_NEGATIVE = 3
+    TIME_SERIES_ALL = TIME_SERIES_ALL
+    TIME_SERIES_POSITIVE = TIME_SERIES_POSITIVE
+    TIME_SERIES_NEGATIVE = TIME_SERIES_NEGATIVE
 
     class Meta:
         abstract = True
 
+    # Related fields to the fewsnorm metadata tables.
+    METADATA_FIELDS = (
+        ('location', GeoLocationCache),
+        ('parameter', ParameterCache),
+        ('module', ModuleCache),
+        ('time_step', TimeStepCache),
+        ('qualifierset', QualifierSetCache),
+        )
+
+    def _related(self, name, model):
+        """
+        Return related object name from the metadata index, falling
+        back to the normal (lazy) lookup.
+        """
+        pk = getattr(self, name + '_id')
+        if pk is not None:
+            obj = metadata.get(model, pk=pk)
+            if obj is not None:
+                return obj
+        return getattr(self, name)
+
     @property
     def fews_norm_source(self):
-        if self.location and self.location.fews_norm_source:
-            return self.location.fews_norm_source
+        location = self._related('location', GeoLocationCache)
+        if location and location.fews_norm_source:
+            return location.fews_norm_source
         else:
             return None
 
+    def _spec_fields(self):
+        """
+        Return the GraphItemSpec fields about location, parameter etc.
+        """
+        result = location_fields(self._related('location', GeoLocationCache))
+        result['location_postpend'] = self.location_postpend
+        result['related_location'] = self.related_location
+        for name, model in GraphItemMixin.METADATA_FIELDS[1:]:
+            obj = self._related(name, model)
+            result[name] = obj.ident if obj is not None else None
+        return result
+
+    def _spec(self):
+        return GraphItemSpec(**self._spec_fields())
+
     def series_params(self):
-        """ Params for series
+        """ Params for series, see GraphItemSpec.series_params
         """
-        params = {}
-        if self.location is not None:
-            ident = self.location.ident
-            # location_postpend
-            if self.location_postpend:
-                ident += self.location_postpend
-            if self.related_location:
-                # Fetch related location ident instead of own location ident
-                source = self.fews_norm_source
-                fews_location = Location.from_raw(
-                    schema_prefix=source.database_schema_name,
-                    ident=ident,
-                    related_location=self.related_location).using(
-                    source.database_name)[0]
-                params['location'] = fews_location.related_location
-            else:
-                # Default
-                params['location'] = ident
-        if self.parameter is not None:
-            params['parameter'] = self.parameter.ident
-        if self.module is not None:
-            params['moduleinstance'] = self.module.ident
-        if self.time_step is not None:
-            params['timestep'] = self.time_step.ident
-        if self.qualifierset is not None:
-            params['qualifierset'] = self.qualifierset.ident
-        return params
+        return self._spec().series_params()
 
     def series(self):
         """Return Series corresponding with this object"""
-        params = self.series_params()
-
-        source = self.fews_norm_source
-        series = Series.from_raw(
-            schema_prefix=source.database_schema_name,
-            params=params).using(source.database_name)
-
-        return series
+        return self._spec().series()
 
     def time_series(
         self, series=None, dt_start=None, dt_end=None, with_comments=False):
         """
-        Return dictionary of timeseries.
-
-        Low level fewsnorm stuff.
-
-        Keys are (location, parameter), value is timeseries object.
-
-        1) which series
-        2) retrieve events (with comments) for each series
-
-        Note: with_comments does nothing anymore, comments are always
-        returned. The option is still there for compatibility.
+        Return dictionary of timeseries, see GraphItemSpec.time_series.
         """
-        if not series:
-            series = self.series()
-        source = self.fews_norm_source
-        events = Event.time_series(source, series, dt_start, dt_end)
-        return events
+        return self._spec().time_series(
+            series=series, dt_start=dt_start, dt_end=dt_end)
 
     def time_series_aggregated(
         self, aggregation, aggregation_period,
-        dt_start=None, dt_end=None):
+        dt_start=None, dt_end=None, series=None):
         """
-        Aggregated time series.
-
-        Result is a dictionary with timeseries. The keys are: (location,
-        parameter, option), where option is (GraphItemMixin.)TIME_SERIES_ALL,
-        TIME_SERIES_POSITIVE or TIME_SERIES_NEGATIVE
-
-        aggregation: see PredefinedGraph
-        'avg', 'sum'
-
-        aggregation_period: see PredefinedGraph
-        'day', 'month', 'quarter', 'year'
+        Aggregated time series, see GraphItemSpec.time_series_aggregated.
         """
-        source = self.fews_norm_source
-        series = self.series()
+        return self._spec().time_series_aggregated(
+            aggregation, aggregation_period,
+            dt_start=dt_start, dt_end=dt_end, series=series)
 
-        result = {}
-        for single_series in series:
-            obj = {
-                GraphItemMixin.TIME_SERIES_ALL: timeseries.TimeSeries(),
-                GraphItemMixin.TIME_SERIES_POSITIVE: timeseries.TimeSeries(),
-                GraphItemMixin.TIME_SERIES_NEGATIVE: timeseries.TimeSeries()}
-            # Somehow get the events with aggregation in it
-            # aggregation == PredefinedGraph.AGGREGATION_AVG, AGGREGATION_SUM
-            # aggregation_period == PredefinedGraph.PERIOD_YEAR, PERIOD_MONTH,
-            # PERIOD_QUARTER, PERIOD_DAY
-            # between dt_start and dt_end
-            events = Event.agg_from_raw(
-                single_series, dt_start=dt_start, dt_end=dt_end,
-                schema_prefix=source.database_schema_name,
-                agg_function=aggregation,
-                agg_period=aggregation_period).using(source.database_name)
-
-            # Put the events in Timeseries objects in obj
-            for event in events:
-                obj[GraphItemMixin.TIME_SERIES_ALL][event.timestamp] = (
-                    event.value, event.flag, event.comment)
-                if event.value >= 0:
-                    obj[GraphItemMixin.TIME_SERIES_POSITIVE][
-                        event.timestamp] = (
-                        event.value, event.flag, event.comment)
-                else:
-                    obj[GraphItemMixin.TIME_SERIES_NEGATIVE][
-                        event.timestamp] = (
-                        event.value, event.flag, event.comment)
-
-            # Now put the timeseries in the result
-            for k in obj.keys():
-                obj[k].location_id = single_series.location
-                obj[k].parameter_id = single_series.parameter
-                obj[k].time_step = single_series.timestep
-                obj[k].units = single_series.unit
-
-                result[single_series.location,
-                       single_series.parameter, k] = obj[k]
-
-        return result
+    def aggregated_time_series_from_events(self, single_series, events):
+        return self._spec().aggregated_time_series_from_events(
+            single_series, events)
 
 
 class GraphItem(GraphItemMixin, GraphLayoutMixin):
@@ -444,12 +445,25 @@ class GraphItem(GraphItemMixin, GraphLayoutMixin):
         return self.layout_as_dict()
 
     @classmethod
-    def from_dict(cls, graph_item_dict):
+    def from_dict(cls, graph_item_dict, locations=None):
         """
         Return a GraphItem created from the provided dictionary.
 
         Note that objects are not saved. Fields predefined_graph nor
-        index are filled.
+        index are filled. See specs_from_dict for the dictionary.
+        """
+        return [GraphItem.from_spec(spec) for spec in
+                GraphItem.specs_from_dict(graph_item_dict, locations)]
+
+    @classmethod
+    def specs_from_dict(cls, graph_item_dict, locations=None):
+        """
+        Return list of GraphItemSpecs created from the provided
+        dictionary.
+
+        locations: optional dict ident -> GeoLocationCache, see
+        geo_locations_by_ident. If not provided, locations are looked up
+        in the metadata index.
 
         The provided dictionary can have the following keys:
         - type: 'line', 'vertical-line', etc.
@@ -465,58 +479,100 @@ class GraphItem(GraphItemMixin, GraphLayoutMixin):
             graph_item_dict['type']]
         location = None
         if 'location' in graph_item_dict:
-            try:
-                location = GeoLocationCache.objects.get(
-                    ident=graph_item_dict['location'])
-            except GeoLocationCache.DoesNotExist:
+            if locations is not None:
+                location = locations.get(graph_item_dict['location'])
+            else:
+                location = metadata.get(
+                    GeoLocationCache, ident=graph_item_dict['location'])
+            if location is None:
                 # TODO: see if "db_name" is provided, then add
                 # location anyway
                 location = GeoLocationCache(
                     ident=graph_item_dict['location'])
-                logger.exception(
+                logger.error(
                     "Ignored not existing GeoLocationCache for ident=%s" %
                     graph_item_dict['location'])
 
         if graph_type == GraphItem.GRAPH_TYPE_PREDEFINED_GRAPH:
             # This is a special case. Return underlying GraphItems
-            try:
-                predefined_graph = PredefinedGraph.objects.get(
-                    slug=graph_item_dict['value'])
-            except PredefinedGraph.DoesNotExist:
-                logger.exception("Tried to fetch a non-existing predefined "
-                                 "graph %s" % graph_item_dict['value'])
+            plan = graph_plan(graph_item_dict['value'])
+            if plan is None:
+                logger.error("Tried to fetch a non-existing predefined "
+                             "graph %s" % graph_item_dict['value'])
                 return []
-            return predefined_graph.unfolded_graph_items(location)
-
-        graph_item = GraphItem()
-        graph_item.graph_type = graph_type
-        graph_item.location = location
-        if 'location_postpend' in graph_item_dict:
-            graph_item.location_postpend = graph_item_dict['location_postpend']
-        if 'parameter' in graph_item_dict:
-            parameter = ParameterCache(ident=graph_item_dict['parameter'])
-            graph_item.parameter = parameter
-        if 'module' in graph_item_dict:
-            module = ModuleCache(ident=graph_item_dict['module'])
-            graph_item.module = module
-        if 'timestep' in graph_item_dict:
-            time_step = TimeStepCache(ident=graph_item_dict['timestep'])
-            graph_item.time_step = time_step
-        if 'qualifierset' in graph_item_dict:
-            qualifier_set = QualifierSetCache(
-                ident=graph_item_dict['qualifierset'])
-            graph_item.qualifierset = qualifier_set
-        if 'polarity' in graph_item_dict:
-            graph_item.value = graph_item_dict['polarity']
-        if 'value' in graph_item_dict:
-            graph_item.value = graph_item_dict['value']
-        if 'related_location' in graph_item_dict:
-            graph_item.related_location = graph_item_dict['related_location']
-        if 'layout' in graph_item_dict:
-            layout_dict = graph_item_dict['layout']
-            graph_item.apply_layout_dict(layout_dict)
-
-        return [graph_item, ]
+            return plan.unfolded_specs(location)
+
+        fields = location_fields(location)
+        fields['graph_type'] = graph_type
+        for key, name in (
+            ('location_postpend', 'location_postpend'),
+            ('parameter', 'parameter'),
+            ('module', 'module'),
+            ('timestep', 'time_step'),
+            ('qualifierset', 'qualifierset'),
+            ('polarity', 'value'),
+            ('value', 'value'),
+            ('related_location', 'related_location')):
+            if key in graph_item_dict:
+                fields[name] = graph_item_dict[key]
+        layout_dict = graph_item_dict.get('layout', {})
+        for attribute, key in LAYOUT_FIELDS:
+            if key in layout_dict:
+                fields[attribute] = layout_dict[key]
+
+        return [GraphItemSpec(**fields), ]
+
+    def to_spec(self):
+        """
+        Return GraphItemSpec of this graph item.
+        """
+        fields = self._spec_fields()
+        fields['graph_type'] = self.graph_type
+        fields['value'] = self.value
+        for attribute, key in LAYOUT_FIELDS:
+            fields[attribute] = getattr(self, attribute)
+        return GraphItemSpec(**fields)
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Return unsaved GraphItem from GraphItemSpec.
+
+        Related objects come from the metadata index. Unknown idents
+        get unsaved objects.
+        """
+        graph_item = GraphItem(
+            graph_type=spec.graph_type,
+            value=spec.value,
+            location_postpend=spec.location_postpend,
+            related_location=spec.related_location)
+        for attribute, key in LAYOUT_FIELDS:
+            setattr(graph_item, attribute, getattr(spec, attribute))
+        for name, model in GraphItemMixin.METADATA_FIELDS:
+            ident = getattr(spec, name)
+            if ident is not None:
+                obj = metadata.get(model, ident=ident)
+                if obj is None:
+                    obj = model(ident=ident)
+                setattr(graph_item, name, obj)
+        return graph_item
+
+    def memory_copy(self):
+        """
+        Return unsaved copy, like from_dict(as_dict()) does.
+
+        Related objects are shared and come from the metadata index
+        where possible.
+        """
+        graph_item = GraphItem(
+            graph_type=self.graph_type,
+            location_postpend=self.location_postpend,
+            related_location=self.related_location,
+            value=self.value)
+        for name, model in GraphItemMixin.METADATA_FIELDS:
+            setattr(graph_item, name, self._related(name, model))
+        graph_item.apply_layout_dict(self.layout_as_dict())
+        return graph_item
 
     def as_dict(self):
         """
@@ -528,20 +584,120 @@ class GraphItem(GraphItemMixin, GraphLayoutMixin):
             'type': GraphItem.GRAPH_TYPES[self.graph_type],
             'layout': self.layout_as_dict(),
             }
-        if self.location is not None:
-            result['location'] = self.location.ident
+        location = self._related('location', GeoLocationCache)
+        if location is not None:
+            result['location'] = location.ident
         if self.location_postpend is not None:
             result['location_postpend'] = self.location_postpend
-        if self.parameter is not None:
-            result['parameter'] = self.parameter.ident
-        if self.module is not None:
-            result['module'] = self.module.ident
-        if self.time_step is not None:
-            result['timestep'] = self.time_step.ident
-        if self.qualifierset is not None:
-            result['qualifierset'] = self.qualifierset.ident
+        for name, model, key in (
+            ('parameter', ParameterCache, 'parameter'),
+            ('module', ModuleCache, 'module'),
+            ('time_step', TimeStepCache, 'timestep'),
+            ('qualifierset', QualifierSetCache, 'qualifierset')):
+            obj = self._related(name, model)
+            if obj is not None:
+                result[key] = obj.ident
         if self.value is not None:
             result['value'] = self.value
         if self.related_location is not None:
             result['related_location'] = self.related_location
         return result
+
+
+def geo_locations_by_ident(idents):
+    """
+    Return dict ident -> GeoLocationCache for the given idents, from
+    the metadata index. Unknown idents are left out.
+    """
+    result = {}
+    for ident in set(idents):
+        location = metadata.get(GeoLocationCache, ident=ident)
+        if location is not None:
+            result[ident] = location
+    return result
+
+
+def location_fields(location):
+    """
+    Return GraphItemSpec fields location and fews_norm_source of
+    GeoLocationCache location (can be None or unsaved).
+    """
+    if location is None:
+        return {'location': None, 'fews_norm_source': None}
+    fews_norm_source = None
+    if location.fews_norm_source_id is not None:
+        fews_norm_source = location.fews_norm_source
+    return {'location': location.ident, 'fews_norm_source': fews_norm_source}
+
+
+class GraphPlan(object):
+    """
+    Compiled predefined graph: graph settings, cache policy and the
+    flattened, ordered list of graph item specs.
+
+    Plans are cached per definitions version, so saving or deleting
+    any PredefinedGraph or GraphItem invalidates them.
+    """
+    def __init__(self, predefined_graph):
+        self.slug = predefined_graph.slug
+        self.graph_settings = predefined_graph.graph_settings()
+        self.cache_stale_after = predefined_graph.cache_stale_after
+        self.cache_expire_after = predefined_graph.cache_expire_after
+        self.specs = [graph_item.to_spec() for graph_item in
+                      predefined_graph.unfolded_graph_items()]
+
+    def unfolded_specs(self, location=None):
+        """
+        Return the graph item specs, like
+        PredefinedGraph.unfolded_graph_items. Specs without location get
+        GeoLocationCache location.
+        """
+        if location is None:
+            return list(self.specs)
+        fields = location_fields(location)
+        return [spec if spec.location else spec.replace(**fields)
+                for spec in self.specs]
+
+
+GRAPH_PLAN_KEY = 'lizard_graph::plan::%s::%s'
+
+# Plans that are used in this process: slug -> (version, plan).
+_graph_plans = {}
+
+
+def graph_plan(slug):
+    """
+    Return GraphPlan of the predefined graph with slug, or None if it
+    does not exist.
+
+    Plans are built on first use after a change of the definitions and
+    kept in the cache and in this process.
+    """
+    version = definitions_version()
+    local = _graph_plans.get(slug)
+    if local is not None and local[0] == version:
+        return local[1]
+
+    key = GRAPH_PLAN_KEY % (version, slug)
+    plan = cache.get(key)
+    if plan is None:
+        try:
+            predefined_graph = PredefinedGraph.objects.get(slug=slug)
+        except PredefinedGraph.DoesNotExist:
+            return None
+        plan = GraphPlan(predefined_graph)
+        cache.set(key, plan)
+    _graph_plans[slug] = (version, plan)
+    return plan
+
+
+# Cached graphs depend on the graph definitions.
+post_save.connect(bump_definitions_version, sender=PredefinedGraph)
+post_delete.connect(bump_definitions_version, sender=PredefinedGraph)
+post_save.connect(bump_definitions_version, sender=GraphItem)
+post_delete.connect(bump_definitions_version, sender=GraphItem)
+
+# The metadata index is reloaded when the fewsnorm metadata changes.
+for model in METADATA_MODELS:
+    post_save.connect(bump_metadata_generation, sender=model)
+    post_delete.connect(bump_metadata_generation, sender=model)
@@ -0,0 +1,172 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Compact serialization of cached time series chunks.
+
+The chunks hold ColumnarSeries (see columnar.py): their arrays are
+pickled as raw bytes, with only the non-empty comments. The result is
+optionally compressed.
+
+Payloads that do not fit in a single cache item (memcached has a 1 MB
+limit) are split over multiple cache keys by PartitionedCache.
+"""
+import cPickle as pickle
+import logging
+import uuid
+import zlib
+
+import numpy as np
+from django.conf import settings
+
+from lizard_graph.columnar import ColumnarSeries
+
+
+logger = logging.getLogger(__name__)
+
+
+COMPRESS = getattr(settings, 'LIZARD_GRAPH_CACHE_COMPRESSION', True)
+
+# Stay below the memcached limit of 1 MB, including the key.
+MAX_ITEM_SIZE = 1000 * 1000
+
+FORMAT_PLAIN = 'p'
+FORMAT_COMPRESSED = 'z'
+
+
+def pack_time_series(ts):
+    """
+    Return compact, picklable form of ColumnarSeries ts.
+    """
+    comments = []
+    if ts.comments is not None:
+        comments = [(index, comment)
+                    for index, comment in enumerate(ts.comments)
+                    if comment]
+    meta = (ts.location_id, ts.parameter_id, ts.time_step, ts.units)
+    return (meta, ts.aware, ts.timestamps.tostring(), ts.values.tostring(),
+            ts.flags.tostring(), comments)
+
+
+def unpack_time_series(packed):
+    """
+    Return ColumnarSeries from pack_time_series result.
+    """
+    meta, aware, timestamps, values, flags, comments = packed
+    timestamps = np.frombuffer(timestamps, dtype=np.int64).copy()
+    values = np.frombuffer(values, dtype=np.float64).copy()
+    flags = np.frombuffer(flags, dtype=np.int16).copy()
+    comment_array = None
+    if comments:
+        comment_array = np.empty(len(timestamps), dtype=object)
+        for index, comment in comments:
+            comment_array[index] = comment
+    location_id, parameter_id, time_step, units = meta
+    return ColumnarSeries(
+        timestamps, values, flags, comment_array, aware=aware,
+        location_id=location_id, parameter_id=parameter_id,
+        time_step=time_step, units=units)
+
+
+def chunk_size(chunk):
+    """
+    Return approximate memory use in bytes of a cached chunk.
+    """
+    size = 1024
+    for ts in chunk['data'].values():
+        size += ts.nbytes
+    return size
+
+
+def dumps_chunk(chunk, compress=COMPRESS):
+    """
+    Return bytes of a cached chunk: dict with 'watermark', 'stored' and
+    'data', a time series dict.
+    """
+    packed = {
+        'watermark': chunk['watermark'],
+        'stored': chunk['stored'],
+        'data': [(key, pack_time_series(ts))
+                 for key, ts in chunk['data'].items()],
+        }
+    payload = pickle.dumps(packed, pickle.HIGHEST_PROTOCOL)
+    if compress:
+        return FORMAT_COMPRESSED + zlib.compress(payload, 1)
+    return FORMAT_PLAIN + payload
+
+
+def loads_chunk(data):
+    """
+    Return cached chunk from dumps_chunk result.
+    """
+    payload = data[1:]
+    if data[0] == FORMAT_COMPRESSED:
+        payload = zlib.decompress(payload)
+    packed = pickle.loads(payload)
+    return {
+        'watermark': packed['watermark'],
+        'stored': packed['stored'],
+        'data': dict([(key, unpack_time_series(packed_ts))
+                      for key, packed_ts in packed['data']]),
+        }
+
+
+class PartitionedCache(object):
+    """
+    Serializing wrapper around a Django cache for time series chunks.
+
+    Values are stored with dumps_chunk. Values bigger than
+    max_item_size are split over multiple keys: the key itself then
+    holds ('parts', token, number of parts). The token makes sure parts
+    of different writes are never mixed.
+    """
+    def __init__(self, cache, max_item_size=MAX_ITEM_SIZE):
+        self.cache = cache
+        self.max_item_size = max_item_size
+
+    def _part_key(self, key, token, index):
+        return '%s::%s::%d' % (key, token, index)
+
+    def get_many(self, keys):
+        stored = self.cache.get_many(keys)
+        part_keys = []
+        for key, value in stored.items():
+            if isinstance(value, tuple):
+                marker, token, count = value
+                part_keys.extend([self._part_key(key, token, index)
+                                  for index in range(count)])
+        parts = {}
+        if part_keys:
+            parts = self.cache.get_many(part_keys)
+
+        result = {}
+        for key, value in stored.items():
+            if isinstance(value, tuple):
+                marker, token, count = value
+                item_part_keys = [self._part_key(key, token, index)
+                                  for index in range(count)]
+                if [part_key for part_key in item_part_keys
+                    if part_key not in parts]:
+                    # One of the parts is evicted: a miss.
+                    continue
+                value = ''.join(
+                    [parts[part_key] for part_key in item_part_keys])
+            try:
+                result[key] = loads_chunk(value)
+            except:
+                logger.exception("Could not load cached chunk %s" % key)
+        return result
+
+    def set_many(self, data, timeout=None):
+        to_cache = {}
+        for key, value in data.items():
+            value = dumps_chunk(value)
+            if len(value) <= self.max_item_size:
+                to_cache[key] = value
+                continue
+            token = uuid.uuid4().hex
+            count = 0
+            for start in range(0, len(value), self.max_item_size):
+                to_cache[self._part_key(key, token, count)] = value[
+                    start:start + self.max_item_size]
+                count += 1
+            to_cache[key] = ('parts', token, count)
+        self.cache.set_many(to_cache, timeout)
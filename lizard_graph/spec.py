@@ -0,0 +1,248 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Lightweight, immutable description of a graph item.
+
+Unsaved GraphItem, GeoLocationCache, ParameterCache etc. instances are
+expensive to create, while a request only needs their idents.
+GraphView and the fetch functions work with GraphItemSpec objects
+instead. GraphItem.to_spec and GraphItem.from_spec convert between the
+two.
+"""
+from lizard_fewsnorm.models import Event
+from lizard_fewsnorm.models import Series
+
+from lizard_graph.columnar import ColumnarSeries
+from lizard_graph.fetch import related_location
+
+
+# Used by time_series_aggregated to 'flag' a time series.
+TIME_SERIES_ALL = 1
+TIME_SERIES_POSITIVE = 2
+TIME_SERIES_NEGATIVE = 3
+
+# (attribute, layout dict key)
+LAYOUT_FIELDS = (
+    ('color', 'color'),
+    ('color_outside', 'color-outside'),
+    ('line_width', 'line-width'),
+    ('line_style', 'line-style'),
+    ('label', 'label'),
+    )
+
+
+def layout_as_dict(layout):
+    """
+    Return layout dict of an object with layout attributes, like
+    GraphLayoutMixin. Empty values are left out.
+    """
+    result = {}
+    for attribute, key in LAYOUT_FIELDS:
+        value = getattr(layout, attribute)
+        if value:
+            result[key] = value
+    return result
+
+
+def sign_split(ts_dict):
+    """
+    Return copy of aggregated time series dict ts_dict, with the
+    TIME_SERIES_POSITIVE and TIME_SERIES_NEGATIVE parts of every
+    TIME_SERIES_ALL series added.
+    """
+    result = dict(ts_dict)
+    for (location, parameter, option), ts in ts_dict.items():
+        if option == TIME_SERIES_ALL:
+            result[location, parameter, TIME_SERIES_POSITIVE] = (
+                ts.sign_part(positive=True))
+            result[location, parameter, TIME_SERIES_NEGATIVE] = (
+                ts.sign_part(positive=False))
+    return result
+
+
+class GraphItemSpec(object):
+    """
+    Immutable graph item.
+
+    location, parameter, module, time_step and qualifierset are fews
+    idents, fews_norm_source is the FewsNormSource of the location. The
+    other fields are the same as those of GraphItem.
+    """
+    __slots__ = (
+        'graph_type', 'value', 'fews_norm_source', 'location',
+        'location_postpend', 'related_location', 'parameter', 'module',
+        'time_step', 'qualifierset', 'color', 'color_outside',
+        'line_width', 'line_style', 'label')
+
+    DEFAULTS = {
+        'color': '',
+        'color_outside': '',
+        }
+
+    def __init__(self, **kwargs):
+        for name in GraphItemSpec.__slots__:
+            object.__setattr__(
+                self, name, kwargs.pop(name, GraphItemSpec.DEFAULTS.get(name)))
+        if kwargs:
+            raise TypeError(
+                'Unknown GraphItemSpec field(s): %s' % ', '.join(kwargs))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('GraphItemSpec is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('GraphItemSpec is immutable')
+
+    def _values(self):
+        return tuple([getattr(self, name)
+                      for name in GraphItemSpec.__slots__])
+
+    def __getstate__(self):
+        return self._values()
+
+    def __setstate__(self, state):
+        for name, value in zip(GraphItemSpec.__slots__, state):
+            object.__setattr__(self, name, value)
+
+    def __eq__(self, other):
+        return (isinstance(other, GraphItemSpec) and
+                self._values() == other._values())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return 'GraphItemSpec(%s)' % ', '.join(
+            ['%s=%r' % (name, getattr(self, name))
+             for name in GraphItemSpec.__slots__
+             if getattr(self, name) != GraphItemSpec.DEFAULTS.get(name)])
+
+    def replace(self, **kwargs):
+        """
+        Return copy with the provided fields replaced.
+        """
+        fields = dict(zip(GraphItemSpec.__slots__, self._values()))
+        fields.update(kwargs)
+        return GraphItemSpec(**fields)
+
+    def layout_as_dict(self):
+        return layout_as_dict(self)
+
+    def series_params(self):
+        """ Params for series
+        """
+        params = {}
+        if self.location is not None:
+            ident = self.location
+            # location_postpend
+            if self.location_postpend:
+                ident += self.location_postpend
+            if self.related_location:
+                # Fetch related location ident instead of own location ident
+                params['location'] = related_location(
+                    self.fews_norm_source, ident, self.related_location)
+            else:
+                # Default
+                params['location'] = ident
+        if self.parameter is not None:
+            params['parameter'] = self.parameter
+        if self.module is not None:
+            params['moduleinstance'] = self.module
+        if self.time_step is not None:
+            params['timestep'] = self.time_step
+        if self.qualifierset is not None:
+            params['qualifierset'] = self.qualifierset
+        return params
+
+    def series(self):
+        """Return Series corresponding with this object"""
+        params = self.series_params()
+
+        source = self.fews_norm_source
+        series = Series.from_raw(
+            schema_prefix=source.database_schema_name,
+            params=params).using(source.database_name)
+
+        return series
+
+    def time_series(
+        self, series=None, dt_start=None, dt_end=None, with_comments=False):
+        """
+        Return dictionary of timeseries.
+
+        Low level fewsnorm stuff.
+
+        Keys are (location, parameter), value is timeseries object.
+
+        1) which series
+        2) retrieve events (with comments) for each series
+
+        Note: with_comments does nothing anymore, comments are always
+        returned. The option is still there for compatibility.
+        """
+        if series is None:
+            series = self.series()
+        source = self.fews_norm_source
+        events = Event.time_series(source, series, dt_start, dt_end)
+        return events
+
+    def time_series_aggregated(
+        self, aggregation, aggregation_period,
+        dt_start=None, dt_end=None, series=None):
+        """
+        Aggregated time series.
+
+        Result is a dictionary with TimeSeries. The keys are: (location,
+        parameter, option), where option is TIME_SERIES_ALL,
+        TIME_SERIES_POSITIVE or TIME_SERIES_NEGATIVE
+
+        aggregation: see PredefinedGraph
+        'avg', 'sum'
+
+        aggregation_period: see PredefinedGraph
+        'day', 'month', 'quarter', 'year'
+
+        series: optional, already resolved series (see
+        fetch.SeriesResolver).
+        """
+        source = self.fews_norm_source
+        if series is None:
+            series = self.series()
+
+        result = {}
+        for single_series in series:
+            # Somehow get the events with aggregation in it
+            # aggregation == PredefinedGraph.AGGREGATION_AVG, AGGREGATION_SUM
+            # aggregation_period == PredefinedGraph.PERIOD_YEAR, PERIOD_MONTH,
+            # PERIOD_QUARTER, PERIOD_DAY
+            # between dt_start and dt_end
+            events = Event.agg_from_raw(
+                single_series, dt_start=dt_start, dt_end=dt_end,
+                schema_prefix=source.database_schema_name,
+                agg_function=aggregation,
+                agg_period=aggregation_period).using(source.database_name)
+            result.update(self.aggregated_time_series_from_events(
+                    single_series, events))
+
+        return dict([(key, ts.to_time_series())
+                     for key, ts in sign_split(result).items()])
+
+    def aggregated_time_series_from_events(self, single_series, events):
+        """
+        Put aggregated events of single_series in a ColumnarSeries.
+
+        Result is a dictionary with key (location, parameter,
+        TIME_SERIES_ALL). Use sign_split for the positive and negative
+        parts.
+        """
+        ts = ColumnarSeries.from_events(
+            [(event.timestamp, event.value, event.flag, event.comment)
+             for event in events],
+            location_id=single_series.location,
+            parameter_id=single_series.parameter,
+            time_step=single_series.timestep,
+            units=single_series.unit)
+        return {(single_series.location, single_series.parameter,
+                 TIME_SERIES_ALL): ts}
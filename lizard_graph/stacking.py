@@ -0,0 +1,164 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Stacking of the ColumnarSeries of a graph.
+
+Instead of adding the components of a stack one by one, all components
+are aligned on a common time axis at once and the stacked sums are
+computed with a cumulative sum over the components.
+
+Bars are aligned exactly: a missing value counts as 0. Lines are
+aligned with last observation carried forward (LOCF), optionally on a
+regular time grid (see time_grid), which bounds the number of points
+whatever the frequencies of the components.
+"""
+import math
+
+import numpy as np
+
+from lizard_graph.columnar import ColumnarSeries
+from lizard_graph.columnar import epoch_seconds
+
+
+# Upper bound of the points per pixel of a time grid, whatever step is
+# asked for.
+MAX_GRID_POINTS_PER_PIXEL = 4
+
+
+def common_axis(series_list):
+    """
+    Return sorted union of the timestamps of series_list.
+    """
+    if not series_list:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(
+            [series.timestamps for series in series_list]))
+
+
+def auto_grid_step(dt_start, dt_end, width):
+    """
+    Return grid step in seconds for about one point per pixel of
+    width from dt_start to dt_end.
+    """
+    span = epoch_seconds(dt_end) - epoch_seconds(dt_start)
+    return max(1, int(math.ceil(float(span) / max(1, width))))
+
+
+def time_grid(dt_start, dt_end, step):
+    """
+    Return regular time axis (epoch seconds) from dt_start up to and
+    including dt_end, with step seconds between the points. The points
+    are multiples of step, so panning keeps the grid in place.
+    """
+    start = epoch_seconds(dt_start)
+    return np.arange(start - start % step, epoch_seconds(dt_end) + step,
+                     step, dtype=np.int64)
+
+
+def stack_bars(components):
+    """
+    Stack bar components.
+
+    components is a list of (name, stack, polarity, series), in drawing
+    order. Components with the same stack are stacked on top of each
+    other; polarity is 1 (upwards) or -1 (downwards).
+
+    Returns dict name -> (bar, bottom). bar is polarity * abs(series),
+    bottom is the sum of the bars below it, on the time axis of the
+    whole stack. Missing values count as 0.
+    """
+    stacks = {}
+    for component in components:
+        stacks.setdefault(component[1], []).append(component)
+
+    result = {}
+    for stack_components in stacks.values():
+        axis = common_axis(
+            [series for name, stack, polarity, series in stack_components])
+        heights = np.zeros((len(stack_components), len(axis)))
+        bars = []
+        for row, (name, stack, polarity, series) in enumerate(
+            stack_components):
+            values = polarity * np.abs(series.values)
+            bars.append(ColumnarSeries(
+                    series.timestamps, values, series.flags,
+                    series.comments, **series.meta()))
+            heights[row, np.searchsorted(axis, series.timestamps)] = values
+        heights[np.isnan(heights)] = 0
+
+        # The bottom of a bar is the sum of the bars before it.
+        bottoms = np.zeros(heights.shape)
+        np.cumsum(heights[:-1], axis=0, out=bottoms[1:])
+
+        for row, (name, stack, polarity, series) in enumerate(
+            stack_components):
+            meta = series.meta()
+            meta['is_locf'] = False
+            result[name] = (
+                bars[row], ColumnarSeries(axis, bottoms[row], **meta))
+    return result
+
+
+def locf_values(series, axis):
+    """
+    Return values of series at the timestamps of axis (sorted), with
+    the last observation carried forward. Before the first observation
+    the value is 0.
+    """
+    result = np.zeros(len(axis))
+    index = np.searchsorted(series.timestamps, axis, side='right') - 1
+    known = index >= 0
+    result[known] = series.values[index[known]]
+    return result
+
+
+def stack_lines(components, grid=None):
+    """
+    Stack line components, with LOCF alignment.
+
+    components is a list of (name, stack, series), in drawing order.
+
+    Returns dict name -> line: the sum of series and all series before
+    it in the same stack. A line has the timestamps of these series.
+
+    If a grid (see time_grid) is given, stacks with more timestamps
+    than the grid are resampled onto it: their lines have the grid
+    points from the first up to the last timestamp of their series.
+    """
+    stacks = {}
+    for component in components:
+        stacks.setdefault(component[1], []).append(component)
+
+    result = {}
+    for stack_components in stacks.values():
+        series_list = [series for name, stack, series in stack_components]
+        axis = common_axis(series_list)
+        if grid is not None and len(axis) > len(grid):
+            # Grid points within the timestamps of the series so far.
+            firsts = np.minimum.accumulate(
+                [series.timestamps[0] if len(series) else axis[-1]
+                 for series in series_list])
+            lasts = np.maximum.accumulate(
+                [series.timestamps[-1] if len(series) else axis[0]
+                 for series in series_list])
+            axis = grid
+            first_row = np.zeros(len(axis), dtype=np.int64)
+            first_row.fill(len(series_list))
+            for row in reversed(range(len(series_list))):
+                first_row[(axis >= firsts[row]) & (axis <= lasts[row])] = row
+        else:
+            # Row of the first component with an event at each
+            # timestamp.
+            first_row = np.zeros(len(axis), dtype=np.int64)
+            first_row.fill(len(series_list))
+            for row, series in reversed(list(enumerate(series_list))):
+                first_row[np.searchsorted(axis, series.timestamps)] = row
+        sums = np.cumsum(
+            [locf_values(series, axis) for series in series_list], axis=0)
+
+        for row, (name, stack, series) in enumerate(stack_components):
+            selection = first_row <= row
+            meta = series.meta()
+            meta['is_locf'] = True
+            result[name] = ColumnarSeries(
+                axis[selection], sums[row][selection], **meta)
+    return result
@@ -1,15 +1,61 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
 import datetime
 import iso8601
+import threading
+import time
+import numpy
+from matplotlib.dates import date2num
+from timeseries import timeseries
 
+import cPickle as pickle
+from StringIO import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.http import HttpResponse
 from django.http import QueryDict
 from django.test import TestCase
+from django.test.client import RequestFactory
 
 from lizard_graph.views import TimeSeriesViewMixin
 from lizard_graph.views import GraphView
 
+from lizard_graph.caching import LocalLRUCache
+from lizard_graph.caching import SingleFlight
+from lizard_graph.caching import TwoTierCache
+from lizard_graph.caching import cached_chunked
+from lizard_graph.caching import chunk_key
+from lizard_graph.caching import contiguous_runs
+from lizard_graph.caching import etag_matches
+from lizard_graph.caching import in_background
+from lizard_graph.caching import month_chunks
+from lizard_graph.caching import period_start
+from lizard_graph.caching import render_cache_key
+from lizard_graph.caching import single_flight
+from lizard_graph.caching import year_chunks
+from lizard_graph.columnar import ColumnarSeries
+from lizard_graph.columnar import date_number
+from lizard_graph.serialization import PartitionedCache
+from lizard_graph.serialization import dumps_chunk
+from lizard_graph.serialization import loads_chunk
+from lizard_graph.downsampling import downsample_indices
+from lizard_graph.stacking import stack_bars
+from lizard_graph.stacking import stack_lines
+from lizard_graph.stacking import time_grid
+from lizard_graph.fetch import aggregated_events_query
+from lizard_graph.fetch import events_query
+from lizard_graph.fetch import related_locations_query
+from lizard_graph.fetch import series_matches
+from lizard_graph.fetch import series_query
+from lizard_graph.fetch import watermarks_query
+
+from lizard_fewsnorm.models import ParameterCache
+
+from lizard_graph.metadata import MetadataIndex
 from lizard_graph.models import PredefinedGraph
 from lizard_graph.models import GraphItem
+from lizard_graph.models import graph_plan
+from lizard_graph.spec import GraphItemSpec
 from lizard_graph.models import GraphLayoutMixin
 
 
@@ -72,7 +118,7 @@ class GraphViewTest(TestCase):
 
         self.assertEquals(len(result), 2)
         for graph_item in result:
-            self.assertTrue(isinstance(graph_item, GraphItem))
+            self.assertTrue(isinstance(graph_item, GraphItemSpec))
 
     def test_graph_items_from_request2(self):
         pg = PredefinedGraph(name='test', slug='test')
@@ -95,7 +141,7 @@ class GraphViewTest(TestCase):
         # 2 results: the graph item from pg2 is "unfolded" in graph
         # items from pg.
         for element in result:
-            self.assertTrue(isinstance(element, GraphItem))
+            self.assertTrue(isinstance(element, GraphItemSpec))
         self.assertEquals(len(result), 2)
 
     def test_graph_items_from_request3(self):
@@ -120,6 +166,16 @@ class GraphViewTest(TestCase):
         self.assertEquals(graph_settings['reset-period'], 'day')
         self.assertEquals(graph_settings['now-line'], 'True')
 
+    def test_graph_items_from_request_unknown_period(self):
+        """Unknown periods fall back to month, aggregations to sum"""
+        result, graph_settings = self.graph_items_from_request(
+            'item={"type":"line","location":"111.1","parameter":"ALM"}&'
+            'aggregation-period=decade&reset-period=week&aggregation=max')
+
+        self.assertEquals(graph_settings['aggregation-period'], 'month')
+        self.assertEquals(graph_settings['reset-period'], 'month')
+        self.assertEquals(graph_settings['aggregation'], 'sum')
+
     def test_graph_items_from_request5(self):
         """
         Add custom location to graph_item.
@@ -134,8 +190,86 @@ class GraphViewTest(TestCase):
 
         self.assertEquals(len(result), 1)
         for graph_item in result:
-            self.assertTrue(isinstance(graph_item, GraphItem))
-            self.assertEquals(graph_item.location.ident, '111.1')
+            self.assertTrue(isinstance(graph_item, GraphItemSpec))
+            self.assertEquals(graph_item.location, '111.1')
+
+    def test_graph_items_from_request_locations(self):
+        """
+        Locations of all items come from the metadata index.
+        """
+        get = ('item={"type":"line","location":"111.1","parameter":"ALM"}&'
+               'item={"type":"line","location":"111.2","parameter":"ALM"}&'
+               'item={"type":"line","location":"111.3","parameter":"ALM"}')
+        # The first request may load the index.
+        self.graph_items_from_request(get)
+        with self.assertNumQueries(0):
+            result, graph_settings = self.graph_items_from_request(get)
+
+        self.assertEquals(len(result), 3)
+        self.assertEquals(
+            [graph_item.location for graph_item in result],
+            ['111.1', '111.2', '111.3'])
+
+    def test_cached_graph_conditional(self):
+        rendered = []
+
+        class CountingGraphView(GraphView):
+            def render_graph(self, dt_start, dt_end, expire_after=None):
+                rendered.append(1)
+                return HttpResponse('graph', content_type='image/png'), True
+
+        get = ('graph=lizard_graph_test_conditional&'
+               'dt_start=2011-03-11 00:00:00&dt_end=2011-03-13 00:00:00')
+        cache.delete(render_cache_key(
+                QueryDict(get), iso8601.parse_date('2011-03-11 00:00:00'),
+                iso8601.parse_date('2011-03-13 00:00:00')))
+        view = CountingGraphView.as_view()
+        response = view(RequestFactory().get('/?' + get))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.content, 'graph')
+        etag = response['ETag']
+        self.assertTrue(response['Last-Modified'])
+
+        # Served from the cache.
+        response = view(RequestFactory().get('/?' + get))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['ETag'], etag)
+        self.assertEquals(len(rendered), 1)
+
+        for if_none_match in (etag, 'W/' + etag):
+            response = view(RequestFactory().get(
+                    '/?' + get, HTTP_IF_NONE_MATCH=if_none_match))
+            self.assertEquals(response.status_code, 304)
+            self.assertEquals(response['ETag'], etag)
+        self.assertEquals(len(rendered), 1)
+
+    def test_incomplete_graph_not_cached(self):
+        class IncompleteGraphView(GraphView):
+            def render_graph(self, dt_start, dt_end, expire_after=None):
+                return HttpResponse('graph', content_type='image/png'), False
+
+        get = ('graph=lizard_graph_test_incomplete&'
+               'dt_start=2011-03-11 00:00:00&dt_end=2011-03-13 00:00:00')
+        request = RequestFactory().get('/?' + get)
+        response = IncompleteGraphView.as_view()(request)
+        self.assertEquals(response.content, 'graph')
+        self.assertEquals(cache.get(render_cache_key(
+                    QueryDict(get),
+                    iso8601.parse_date('2011-03-11 00:00:00'),
+                    iso8601.parse_date('2011-03-13 00:00:00'))), None)
+
+
+class WarmGraphCacheTest(TestCase):
+    def test_data_only(self):
+        pg = PredefinedGraph(name='test', slug='test')
+        pg.save()
+        stdout = StringIO()
+        call_command('warm_graph_cache', 'test',
+                     locations=['loc1', 'loc2'], stdout=stdout)
+        output = stdout.getvalue()
+        self.assertTrue('test loc1: ' in output)
+        self.assertTrue('test loc2: ' in output)
+        self.assertTrue('Warmed 2 graph(s)' in output)
 
 
 class GraphLayoutMixinTest(TestCase):
@@ -303,6 +437,40 @@ class GraphItemTest(TestCase):
         self.assertEquals(graph_items[1].value, 'sub-1')
         self.assertEquals(graph_items[2].value, 'sub-2')
 
+    def test_unfolded_graph_items_queries(self):
+        pg = PredefinedGraph(name='test', slug='test-graph')
+        pg.save()
+        pg2 = PredefinedGraph(name='test', slug='test-graph-sub')
+        pg2.save()
+        for index in range(10):
+            pg.graphitem_set.create(
+                graph_type=GraphItem.GRAPH_TYPE_LINE, index=index)
+            pg2.graphitem_set.create(
+                graph_type=GraphItem.GRAPH_TYPE_LINE, index=index)
+        pg.graphitem_set.create(
+            graph_type=GraphItem.GRAPH_TYPE_PREDEFINED_GRAPH,
+            value='test-graph-sub', index=100)
+        pg.graphitem_set.create(
+            graph_type=GraphItem.GRAPH_TYPE_PREDEFINED_GRAPH,
+            value='test-graph-sub', index=110)
+
+        # Graph items, nested graphs, graph items of nested graphs.
+        with self.assertNumQueries(3):
+            graph_items = pg.unfolded_graph_items()
+        self.assertEquals(len(graph_items), 30)
+        self.assertEquals(len(set([id(graph_item)
+                                   for graph_item in graph_items])), 30)
+
+    def test_unfolded_graph_items_recursive(self):
+        pg = PredefinedGraph(name='test', slug='test-graph')
+        pg.save()
+        pg.graphitem_set.create(
+            graph_type=GraphItem.GRAPH_TYPE_LINE, index=100)
+        pg.graphitem_set.create(
+            graph_type=GraphItem.GRAPH_TYPE_PREDEFINED_GRAPH,
+            value='test-graph', index=110)
+        self.assertEquals(len(pg.unfolded_graph_items()), 1)
+
     def test_from_dict_predefined_graph3(self):
         graph_item_dict = {
             'type': 'predefined-graph',
@@ -310,3 +478,636 @@ class GraphItemTest(TestCase):
             }
         graph_items = GraphItem.from_dict(graph_item_dict)
         self.assertEquals(len(graph_items), 0)
+
+
+class MetadataIndexTest(TestCase):
+    def test_get(self):
+        index = MetadataIndex()
+        parameter = ParameterCache(ident='test-parameter')
+        parameter.save()
+        self.assertEquals(
+            index.get(ParameterCache, ident='test-parameter').pk,
+            parameter.pk)
+        self.assertEquals(
+            index.get(ParameterCache, pk=parameter.pk).ident,
+            'test-parameter')
+        self.assertEquals(index.get(ParameterCache, ident='unknown'), None)
+        with self.assertNumQueries(0):
+            index.get(ParameterCache, ident='test-parameter')
+
+    def test_generation(self):
+        index = MetadataIndex(check_interval=0)
+        self.assertEquals(index.get(ParameterCache, ident='test-new'), None)
+        # Saving bumps the generation.
+        ParameterCache(ident='test-new').save()
+        self.assertEquals(
+            index.get(ParameterCache, ident='test-new').ident, 'test-new')
+
+
+class GraphPlanTest(TestCase):
+    def test_graph_plan(self):
+        pg = PredefinedGraph(name='test', slug='test-plan', title='Test')
+        pg.save()
+        pg.graphitem_set.create(value='item-1', index=100)
+        plan = graph_plan('test-plan')
+        self.assertEquals(plan.graph_settings, {'title': 'Test'})
+        self.assertEquals(
+            [spec.value for spec in plan.unfolded_specs()], ['item-1'])
+        with self.assertNumQueries(0):
+            graph_plan('test-plan')
+
+    def test_graph_plan_invalidated(self):
+        pg = PredefinedGraph(name='test', slug='test-plan')
+        pg.save()
+        pg.graphitem_set.create(value='item-1', index=100)
+        graph_plan('test-plan')
+        pg.graphitem_set.create(value='item-2', index=110)
+        self.assertEquals(len(graph_plan('test-plan').unfolded_specs()), 2)
+
+    def test_graph_plan_does_not_exist(self):
+        self.assertEquals(graph_plan('does-not-exist'), None)
+
+
+class GraphItemSpecTest(TestCase):
+    def test_immutable(self):
+        spec = GraphItemSpec(graph_type=GraphItem.GRAPH_TYPE_LINE)
+        self.assertRaises(AttributeError, setattr, spec, 'value', 'x')
+        self.assertEquals(spec.replace(value='x').value, 'x')
+        self.assertEquals(spec.value, None)
+
+    def test_unknown_field(self):
+        self.assertRaises(TypeError, GraphItemSpec, unknown='x')
+
+    def test_pickle(self):
+        spec = GraphItemSpec(
+            graph_type=GraphItem.GRAPH_TYPE_LINE, location='111.1',
+            parameter='ALMR110', color='red')
+        self.assertEquals(
+            pickle.loads(pickle.dumps(spec, pickle.HIGHEST_PROTOCOL)), spec)
+
+    def test_specs_from_dict(self):
+        specs = GraphItem.specs_from_dict(
+            {'type': 'line', 'location': '111.1', 'parameter': 'ALMR110',
+             'timestep': 'SETS1440', 'layout': {'color-outside': 'blue'}})
+        self.assertEquals(len(specs), 1)
+        self.assertEquals(specs[0].parameter, 'ALMR110')
+        self.assertEquals(specs[0].time_step, 'SETS1440')
+        self.assertEquals(specs[0].color_outside, 'blue')
+        self.assertEquals(specs[0].series_params(), {
+                'location': '111.1', 'parameter': 'ALMR110',
+                'timestep': 'SETS1440'})
+
+    def test_to_spec_from_spec(self):
+        graph_item_dict = {
+            'type': 'line', 'location': '111.1', 'parameter': 'ALMR110',
+            'module': 'ImportLM', 'value': 'test',
+            'layout': {'color': 'red', 'line-width': 2}}
+        spec = GraphItem.specs_from_dict(graph_item_dict)[0]
+        graph_item = GraphItem.from_spec(spec)
+        self.assertEquals(graph_item.as_dict(), graph_item_dict)
+        self.assertEquals(graph_item.to_spec(), spec)
+
+
+class FetchTest(TestCase):
+    class MockSource(object):
+        database_name = 'fewsnorm'
+        database_schema_name = 'nskv00_opdb'
+
+    class MockSeries(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    def test_series_query(self):
+        query, params = series_query(self.MockSource(), [
+                {'location': '111.1', 'parameter': 'ALMR110'},
+                {'location': '111.2', 'parameter': 'ALMR110',
+                 'moduleinstance': 'ImportLM'}])
+        self.assertEquals(
+            params, ['111.1', 'ALMR110', '111.2', 'ALMR110', 'ImportLM'])
+        self.assertTrue('nskv00_opdb.timeserieskeys' in query)
+        self.assertEquals(query.count(' OR '), 1)
+
+    def test_related_locations_query(self):
+        query, params = related_locations_query(self.MockSource())
+        self.assertTrue('nskv00_opdb.locations' in query)
+        self.assertTrue('l_gebied' in query)
+        self.assertEquals(params, [])
+
+    def test_series_matches(self):
+        single_series = self.MockSeries(
+            location='111.1', parameter='ALMR110',
+            moduleinstance='ImportLM', timestep='nonequidistant',
+            qualifierset=None)
+        self.assertTrue(series_matches(
+                single_series, {'location': '111.1'}))
+        self.assertTrue(series_matches(
+                single_series, {'location': '111.1',
+                                'moduleinstance': 'ImportLM'}))
+        self.assertFalse(series_matches(
+                single_series, {'location': '111.1',
+                                'parameter': 'WNSP'}))
+
+    def test_events_query(self):
+        query, params = events_query(
+            self.MockSource(), [3, 5], 'start', 'end')
+        self.assertEquals(params, [3, 5, 'start', 'end'])
+        self.assertTrue('IN (%s, %s)' in query)
+
+    def test_aggregated_events_query(self):
+        query, params = aggregated_events_query(
+            self.MockSource(), [3], 'start', 'end', 'sum', 'month')
+        self.assertTrue("date_trunc('month'" in query)
+        self.assertTrue('SUM(' in query)
+        self.assertRaises(
+            ValueError, aggregated_events_query,
+            self.MockSource(), [3], 'start', 'end', 'sum', 'decade')
+
+    def test_watermarks_query(self):
+        query, params = watermarks_query(
+            self.MockSource(), [3, 5], [('jan', 'feb'), ('feb', 'mar')])
+        self.assertEquals(params, ['jan', 'feb', 'feb', 'mar', 3, 5])
+        self.assertTrue('VALUES (0, %s, %s), (1, %s, %s)' in query)
+        self.assertFalse('SUM(' in query)
+
+
+class CachingTest(TestCase):
+    def test_period_start(self):
+        dt = datetime.datetime(2011, 11, 15, 13, 30)
+        self.assertEquals(period_start(dt, 'day'),
+                          datetime.datetime(2011, 11, 15))
+        self.assertEquals(period_start(dt, 'month'),
+                          datetime.datetime(2011, 11, 1))
+        self.assertEquals(period_start(dt, 'quarter'),
+                          datetime.datetime(2011, 10, 1))
+        self.assertEquals(period_start(dt, 'year'),
+                          datetime.datetime(2011, 1, 1))
+
+    def test_month_chunks(self):
+        chunks = month_chunks(datetime.datetime(2011, 11, 15),
+                              datetime.datetime(2012, 2, 1))
+        self.assertEquals(len(chunks), 4)
+        self.assertEquals(chunks[0], (
+                datetime.datetime(2011, 11, 1, tzinfo=iso8601.iso8601.UTC),
+                datetime.datetime(2011, 12, 1, tzinfo=iso8601.iso8601.UTC)))
+        self.assertEquals(chunks[-1], (
+                datetime.datetime(2012, 2, 1, tzinfo=iso8601.iso8601.UTC),
+                datetime.datetime(2012, 3, 1, tzinfo=iso8601.iso8601.UTC)))
+
+    def test_month_chunks_timezone(self):
+        """
+        Chunks are in UTC: the same window in another timezone gives
+        the same chunks.
+        """
+        chunks = month_chunks(
+            iso8601.parse_date('2011-11-01T00:30:00+01:00'),
+            iso8601.parse_date('2011-12-01T00:30:00+01:00'))
+        self.assertEquals(chunks, month_chunks(
+                datetime.datetime(2011, 10, 31, 23, 30),
+                datetime.datetime(2011, 11, 30, 23, 30)))
+        self.assertEquals(chunks[0][0].month, 10)
+
+    def test_year_chunks(self):
+        chunks = year_chunks(datetime.datetime(2011, 11, 15),
+                             datetime.datetime(2012, 2, 1))
+        self.assertEquals(chunks, [
+                (datetime.datetime(2011, 1, 1, tzinfo=iso8601.iso8601.UTC),
+                 datetime.datetime(2012, 1, 1, tzinfo=iso8601.iso8601.UTC)),
+                (datetime.datetime(2012, 1, 1, tzinfo=iso8601.iso8601.UTC),
+                 datetime.datetime(2013, 1, 1, tzinfo=iso8601.iso8601.UTC))])
+
+    def test_render_cache_key(self):
+        dt_start = datetime.datetime(2011, 1, 1)
+        dt_end = datetime.datetime(2011, 2, 1)
+        key1 = render_cache_key(
+            QueryDict('graph=test&location=111.1&dt_start=2011-01-01'),
+            dt_start, dt_end)
+        key2 = render_cache_key(
+            QueryDict('location=111.1&graph=test'), dt_start, dt_end)
+        key3 = render_cache_key(
+            QueryDict('location=111.2&graph=test'), dt_start, dt_end)
+        self.assertEquals(key1, key2)
+        self.assertNotEquals(key1, key3)
+
+    def test_render_cache_key_definitions_changed(self):
+        dt_start = datetime.datetime(2011, 1, 1)
+        dt_end = datetime.datetime(2011, 2, 1)
+        key1 = render_cache_key(QueryDict('graph=test'), dt_start, dt_end)
+        PredefinedGraph(name='test', slug='test').save()
+        key2 = render_cache_key(QueryDict('graph=test'), dt_start, dt_end)
+        self.assertNotEquals(key1, key2)
+
+    def test_etag_matches(self):
+        class MockRequest(object):
+            META = {'HTTP_IF_NONE_MATCH': '"abc", "def"'}
+        self.assertTrue(etag_matches(MockRequest(), '"def"'))
+        self.assertFalse(etag_matches(MockRequest(), '"ghi"'))
+
+    def test_etag_matches_weak(self):
+        class MockRequest(object):
+            META = {'HTTP_IF_NONE_MATCH': 'W/"abc"'}
+        self.assertTrue(etag_matches(MockRequest(), '"abc"'))
+
+    def test_cached_chunked_deduplicates(self):
+        fetched = []
+
+        def fetch(graph_items, dt_start, dt_end):
+            fetched.append(len(graph_items))
+            result = {}
+            for graph_item in graph_items:
+                ts = ColumnarSeries.from_events([(dt_start, 1.0, 0, None)])
+                result[id(graph_item)] = {('loc', 'par', 'unit'): ts}
+            return result
+
+        def watermarks(graph_items, chunks):
+            return dict([(id(graph_item), [(1, )] * len(chunks))
+                         for graph_item in graph_items])
+
+        keys = ['lizard_graph_test_a', 'lizard_graph_test_a',
+                'lizard_graph_test_b']
+        graph_items = [object(), object(), object()]
+        keys_by_id = dict(zip([id(graph_item) for graph_item in graph_items],
+                              keys))
+        dt_start = datetime.datetime(2011, 1, 10)
+        dt_end = datetime.datetime(2011, 1, 20)
+        result = cached_chunked(
+            graph_items, lambda graph_item: keys_by_id[id(graph_item)],
+            month_chunks(dt_start, dt_end), fetch, watermarks,
+            dt_start, dt_end)
+        self.assertEquals(fetched, [2])
+        self.assertEquals(len(result), 3)
+        self.assertTrue(
+            result[id(graph_items[0])] is result[id(graph_items[1])])
+
+    def test_contiguous_runs(self):
+        self.assertEquals(contiguous_runs([3, 0, 1, 5, 6]),
+                          [(0, 1), (3, 3), (5, 6)])
+        self.assertEquals(contiguous_runs([]), [])
+
+    def test_cached_chunked_contiguous_runs(self):
+        fetched = []
+
+        def fetch(graph_items, dt_start, dt_end):
+            fetched.append((dt_start.month, dt_end.month))
+            result = {}
+            for graph_item in graph_items:
+                ts = ColumnarSeries.from_events([(dt_start, 1.0, 0, None)])
+                result[id(graph_item)] = {('loc', 'par', 'unit'): ts}
+            return result
+
+        def watermarks(graph_items, chunks):
+            return dict([(id(graph_item), [(1, )] * len(chunks))
+                         for graph_item in graph_items])
+
+        graph_item = object()
+        chunks = month_chunks(datetime.datetime(2011, 1, 10),
+                              datetime.datetime(2011, 5, 20))
+        # February is cached already.
+        cached_chunked(
+            [graph_item], lambda graph_item: 'lizard_graph_test_runs',
+            chunks[1:2], fetch, watermarks, chunks[1][0], chunks[1][0])
+        del fetched[:]
+        cached_chunked(
+            [graph_item], lambda graph_item: 'lizard_graph_test_runs',
+            chunks, fetch, watermarks, chunks[0][0], chunks[-1][0])
+        self.assertEquals(sorted(fetched), [(1, 2), (3, 6)])
+
+    def test_local_lru_cache(self):
+        local_cache = LocalLRUCache(100, sizeof=lambda value: value)
+        local_cache.set('a', 40)
+        local_cache.set('b', 40)
+        local_cache.get('a')  # 'b' is now least recently used
+        local_cache.set('c', 40)
+        self.assertEquals(local_cache.get('a'), 40)
+        self.assertEquals(local_cache.get('b'), None)
+        self.assertEquals(local_cache.get('c'), 40)
+        self.assertEquals(local_cache.size, 80)
+
+    def test_local_lru_cache_too_big(self):
+        local_cache = LocalLRUCache(100, sizeof=lambda value: value)
+        local_cache.set('a', 200)
+        self.assertEquals(local_cache.get('a'), None)
+        self.assertEquals(local_cache.size, 0)
+
+    def test_two_tier_cache_local_timeout(self):
+        local_cache = LocalLRUCache(100, sizeof=lambda value: 1)
+        two_tier_cache = TwoTierCache(local_cache, cache, local_timeout=-1)
+        cache.set('lizard_graph_test_two_tier', 'shared')
+        two_tier_cache.get_many(['lizard_graph_test_two_tier'])
+        # Copied locally, but already expired.
+        self.assertEquals(local_cache.get('lizard_graph_test_two_tier'),
+                          None)
+
+    def test_two_tier_cache_accept(self):
+        local_cache = LocalLRUCache(100, sizeof=lambda value: 1)
+        two_tier_cache = TwoTierCache(local_cache, cache)
+        local_cache.set('lizard_graph_test_two_tier', 'old')
+        cache.set('lizard_graph_test_two_tier', 'new')
+        self.assertEquals(
+            two_tier_cache.get_many(['lizard_graph_test_two_tier']),
+            {'lizard_graph_test_two_tier': 'old'})
+        self.assertEquals(
+            two_tier_cache.get_many(
+                ['lizard_graph_test_two_tier'],
+                accept=lambda key, value: value == 'new'),
+            {'lizard_graph_test_two_tier': 'new'})
+        self.assertEquals(local_cache.get('lizard_graph_test_two_tier'),
+                          'new')
+
+
+class SerializationTest(TestCase):
+    def chunk(self):
+        ts = timeseries.TimeSeries()
+        ts.units = 'm'
+        for index in range(1000):
+            ts[datetime.datetime(2011, 1, 1) +
+               datetime.timedelta(minutes=15 * index)] = (
+                index * 0.5, 0, 'comment' if index == 7 else None)
+        return {'watermark': ((1, 1000, None), ),
+                'stored': 1350000000.0,
+                'data': {('111.1', 'ALMR110', 'm'):
+                             ColumnarSeries.from_time_series(ts)}}
+
+    def assertChunkEquals(self, chunk1, chunk2):
+        self.assertEquals(chunk1['watermark'], chunk2['watermark'])
+        self.assertEquals(chunk1['stored'], chunk2['stored'])
+        ts1 = chunk1['data'][('111.1', 'ALMR110', 'm')]
+        ts2 = chunk2['data'][('111.1', 'ALMR110', 'm')]
+        self.assertEquals(ts1.get_events(), ts2.get_events())
+        self.assertEquals(ts1.units, ts2.units)
+
+    def test_dumps_loads_chunk(self):
+        chunk = self.chunk()
+        self.assertChunkEquals(loads_chunk(dumps_chunk(chunk)), chunk)
+        self.assertChunkEquals(
+            loads_chunk(dumps_chunk(chunk, compress=False)), chunk)
+
+    def test_partitioned_cache(self):
+        chunk = self.chunk()
+        partitioned_cache = PartitionedCache(cache, max_item_size=1000)
+        partitioned_cache.set_many({'lizard_graph_test_chunk': chunk})
+        self.assertTrue(isinstance(
+                cache.get('lizard_graph_test_chunk'), tuple))
+        result = partitioned_cache.get_many(['lizard_graph_test_chunk'])
+        self.assertChunkEquals(result['lizard_graph_test_chunk'], chunk)
+
+
+class ColumnarSeriesTest(TestCase):
+    def test_time_series_round_trip(self):
+        ts = timeseries.TimeSeries()
+        ts.units = 'm'
+        ts[datetime.datetime(2011, 1, 2)] = (2.0, None, 'comment')
+        ts[datetime.datetime(2011, 1, 1)] = (None, 6, None)
+        columnar = ColumnarSeries.from_time_series(ts)
+        self.assertEquals(len(columnar), 2)
+        self.assertEquals(columnar.get_events(), ts.get_events())
+        result = columnar.to_time_series()
+        self.assertEquals(result.get_events(), ts.get_events())
+        self.assertEquals(result.units, 'm')
+
+    def test_from_events_unsorted(self):
+        dt = datetime.datetime(2011, 1, 1)
+        columnar = ColumnarSeries.from_events([
+                (dt + datetime.timedelta(days=1), 1.0, 0, None),
+                (dt, 2.0, 0, None),
+                (dt + datetime.timedelta(days=1), 3.0, 0, None)])
+        self.assertEquals(
+            columnar.get_events(),
+            [(dt, (2.0, 0, None)),
+             (dt + datetime.timedelta(days=1), (3.0, 0, None))])
+
+    def test_add(self):
+        dt = datetime.datetime(2011, 1, 1)
+        day = datetime.timedelta(days=1)
+        ts1 = ColumnarSeries.from_events(
+            [(dt, 1.0, 0, None), (dt + 2 * day, 2.0, 0, None)])
+        ts2 = ColumnarSeries.from_events([(dt + day, 10.0, 0, None)])
+        self.assertEquals(
+            [event[0] for timestamp, event in (ts1 + ts2).get_events()],
+            [1.0, 10.0, 2.0])
+        ts1.is_locf = True
+        self.assertEquals(
+            [event[0] for timestamp, event in (ts1 + ts2).get_events()],
+            [1.0, 11.0, 2.0])
+
+    def test_scalar(self):
+        dt = datetime.datetime(2011, 1, 1)
+        ts = ColumnarSeries.from_events([(dt, -2.0, 0, None)])
+        self.assertEquals((-1 * abs(ts)).get_events(),
+                          [(dt, (-2.0, 0, None))])
+        self.assertEquals((0 + ts * 0).get_events(), [(dt, (0.0, 0, None))])
+
+    def test_cumulative(self):
+        dt = datetime.datetime(2011, 3, 31, 12)
+        ts = ColumnarSeries.from_events(
+            [(dt + datetime.timedelta(hours=6 * index), 1.0, 0, None)
+             for index in range(6)])
+        self.assertEquals(list(ts.cumulative('day').values),
+                          [1.0, 2.0, 1.0, 2.0, 3.0, 4.0])
+        self.assertEquals(list(ts.cumulative('quarter').values),
+                          [1.0, 2.0, 1.0, 2.0, 3.0, 4.0])
+        self.assertEquals(list(ts.cumulative('year').values),
+                          [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+        self.assertEquals(list(ts.values), [1.0] * 6)
+        ts.cumulative('month', in_place=True)
+        self.assertEquals(list(ts.values), [1.0, 2.0, 1.0, 2.0, 3.0, 4.0])
+
+    def test_sign_part(self):
+        dt = datetime.datetime(2011, 1, 1)
+        day = datetime.timedelta(days=1)
+        ts = ColumnarSeries.from_events(
+            [(dt, 1.0, 0, None), (dt + day, -2.0, 0, None),
+             (dt + 2 * day, 0.0, 0, None)])
+        self.assertEquals(list(ts.sign_part(True).values), [1.0, 0.0])
+        self.assertEquals(list(ts.sign_part(False).values), [-2.0])
+
+    def test_date_number(self):
+        dt = datetime.datetime(2011, 1, 1, 12)
+        self.assertAlmostEquals(date_number(dt), date2num(dt))
+
+    def test_window(self):
+        dt = datetime.datetime(2011, 1, 1)
+        day = datetime.timedelta(days=1)
+        ts = ColumnarSeries.from_events(
+            [(dt + index * day, index, 0, None) for index in range(5)])
+        self.assertEquals(len(ts.window(dt + day, dt + 3 * day)), 3)
+        self.assertEquals(
+            len(ts.window(dt + day, dt + 3 * day, include_end=False)), 2)
+
+
+class StackingTest(TestCase):
+    def test_stack_bars(self):
+        dt = datetime.datetime(2011, 1, 1)
+        day = datetime.timedelta(days=1)
+        ts1 = ColumnarSeries.from_events(
+            [(dt, 1.0, 0, None), (dt + day, -2.0, 0, None)])
+        ts2 = ColumnarSeries.from_events(
+            [(dt + day, 3.0, 0, None), (dt + 2 * day, 4.0, 0, None)])
+        ts3 = ColumnarSeries.from_events([(dt, 5.0, 0, None)])
+        result = stack_bars([
+                ('a', 'bar-positive', 1, ts1),
+                ('b', 'bar-negative', -1, ts3),
+                ('c', 'bar-positive', 1, ts2)])
+        bar, bottom = result['a']
+        self.assertEquals(list(bar.values), [1.0, 2.0])
+        self.assertEquals(list(bottom.values), [0.0, 0.0, 0.0])
+        bar, bottom = result['c']
+        self.assertEquals(list(bar.values), [3.0, 4.0])
+        self.assertEquals(list(bottom.values), [1.0, 2.0, 0.0])
+        bar, bottom = result['b']
+        self.assertEquals(list(bar.values), [-5.0])
+        self.assertEquals(list(bottom.values), [0.0])
+
+    def test_stack_bars_same_series_twice(self):
+        """
+        The same series drawn twice (like a graph item that occurs twice
+        in a graph) is stacked twice.
+        """
+        ts = ColumnarSeries.from_events(
+            [(datetime.datetime(2011, 1, 1), 2.0, 0, None)])
+        key = ('loc', 'par', 'unit')
+        result = stack_bars([
+                ((0, key), 'bar-positive', 1, ts),
+                ((1, key), 'bar-positive', 1, ts)])
+        self.assertEquals(list(result[0, key][1].values), [0.0])
+        self.assertEquals(list(result[1, key][1].values), [2.0])
+
+    def test_stack_lines(self):
+        dt = datetime.datetime(2011, 1, 1)
+        hour = datetime.timedelta(hours=1)
+        ts1 = ColumnarSeries.from_events(
+            [(dt, 1.0, 0, None), (dt + 2 * hour, 2.0, 0, None)])
+        ts2 = ColumnarSeries.from_events(
+            [(dt + hour, 10.0, 0, None), (dt + 3 * hour, 20.0, 0, None)])
+        result = stack_lines([('a', 'line', ts1), ('b', 'line', ts2)])
+        self.assertEquals(list(result['a'].values), [1.0, 2.0])
+        self.assertEquals(list(result['b'].values), [1.0, 11.0, 12.0, 22.0])
+        self.assertTrue(result['b'].is_locf)
+
+    def test_stack_lines_grid(self):
+        dt = datetime.datetime(2011, 1, 1)
+        minute = datetime.timedelta(minutes=1)
+        ts1 = ColumnarSeries.from_events(
+            [(dt + index * minute, 1.0, 0, None) for index in range(600)])
+        ts2 = ColumnarSeries.from_events(
+            [(dt + 120 * minute, 10.0, 0, None)])
+        grid = time_grid(dt, dt + 600 * minute, 3600)
+        self.assertEquals(len(grid), 11)
+        result = stack_lines([('a', 'line', ts1), ('b', 'line', ts2)],
+                             grid=grid)
+        self.assertEquals(len(result['a']), 10)
+        self.assertEquals(list(result['b'].values),
+                          [1.0, 1.0, 11.0, 11.0, 11.0, 11.0, 11.0, 11.0,
+                           11.0, 11.0])
+        # Coarse stacks are left alone.
+        result = stack_lines([('b', 'line', ts2)], grid=grid)
+        self.assertEquals(len(result['b']), 1)
+
+    def test_stack_grid_clamped(self):
+        graph_settings = {'stack-grid-step': 1, 'width': 100,
+                          'downsample': True, 'format': 'png'}
+        grid = GraphView()._stack_grid(
+            graph_settings, datetime.datetime(2011, 1, 1),
+            datetime.datetime(2012, 1, 1))
+        self.assertTrue(len(grid) <= 4 * 100 + 2)
+
+    def test_stack_grid_opt_in(self):
+        graph_settings = {'stack-grid-step': None, 'width': 100,
+                          'downsample': True, 'format': 'png'}
+        self.assertEquals(GraphView()._stack_grid(
+                graph_settings, datetime.datetime(2011, 1, 1),
+                datetime.datetime(2012, 1, 1)), None)
+
+
+class DownsamplingTest(TestCase):
+    def test_downsample_indices(self):
+        timestamps = numpy.arange(100, dtype=numpy.int64)
+        values = numpy.zeros(100)
+        values[13] = 5.0
+        values[14] = -5.0
+        values[60] = numpy.nan
+        indices = list(downsample_indices(timestamps, values, 0, 100, 2))
+        self.assertEquals(indices, [0, 13, 14, 49, 50, 60, 99])
+
+    def test_downsample_indices_small(self):
+        timestamps = numpy.arange(10, dtype=numpy.int64)
+        self.assertEquals(
+            len(downsample_indices(timestamps, numpy.zeros(10), 0, 10, 100)),
+            10)
+
+
+class SingleFlightTest(TestCase):
+    def setUp(self):
+        self.single_flight = SingleFlight(
+            cache, cache, wait_timeout=0.2, poll_interval=0.05)
+        cache.delete('lock::lizard_graph_test')
+        cache.delete('lizard_graph_test')
+
+    def test_acquire(self):
+        self.assertTrue(self.single_flight.acquire('lizard_graph_test'))
+        self.assertFalse(self.single_flight.acquire('lizard_graph_test'))
+        self.single_flight.release('lizard_graph_test')
+        self.assertTrue(self.single_flight.acquire('lizard_graph_test'))
+        self.single_flight.release('lizard_graph_test')
+
+    def test_wait(self):
+        self.assertEquals(
+            self.single_flight.wait(['lizard_graph_test']), {})
+        cache.set('lizard_graph_test', 'result')
+        self.assertEquals(
+            self.single_flight.wait(['lizard_graph_test']),
+            {'lizard_graph_test': 'result'})
+
+    def test_wait_accept(self):
+        cache.set('lizard_graph_test', 'old result')
+        self.assertEquals(
+            self.single_flight.wait(
+                ['lizard_graph_test'],
+                accept=lambda key, value: value != 'old result'),
+            {})
+
+    def test_in_background(self):
+        done = threading.Event()
+        self.assertTrue(in_background(done.set))
+        done.wait(5)
+        self.assertTrue(done.is_set())
+
+    def test_wait_released(self):
+        """Waiting stops when the lock is released without result"""
+        single_flight = SingleFlight(cache, cache, wait_timeout=30)
+        single_flight.acquire('lizard_graph_test')
+        threading.Timer(
+            0.2, single_flight.release, ['lizard_graph_test']).start()
+        started = time.time()
+        self.assertEquals(single_flight.wait(['lizard_graph_test']), {})
+        self.assertTrue(time.time() - started < 5)
+
+    def test_cached_chunked_owner_failed(self):
+        """
+        The waiter fetches itself as soon as the owner gives up.
+        """
+        fetched = []
+
+        def fetch(graph_items, dt_start, dt_end):
+            fetched.append(len(graph_items))
+            ts = ColumnarSeries.from_events([(dt_start, 1.0, 0, None)])
+            return dict([(id(graph_item), {('loc', 'par', 'unit'): ts})
+                         for graph_item in graph_items])
+
+        def watermarks(graph_items, chunks):
+            return dict([(id(graph_item), [(1, )] * len(chunks))
+                         for graph_item in graph_items])
+
+        chunks = month_chunks(datetime.datetime(2011, 1, 10),
+                              datetime.datetime(2011, 1, 20))
+        key = chunk_key('lizard_graph_test_failed', chunks[0][0])
+        # Another worker holds the lock and fails, without a result.
+        self.assertTrue(single_flight.acquire(key))
+        threading.Timer(0.2, single_flight.release, [key]).start()
+        graph_item = object()
+        started = time.time()
+        result = cached_chunked(
+            [graph_item], lambda graph_item: 'lizard_graph_test_failed',
+            chunks, fetch, watermarks, chunks[0][0], chunks[0][1])
+        self.assertTrue(time.time() - started < 5)
+        self.assertEquals(fetched, [1])
+        self.assertTrue(id(graph_item) in result)
@@ -4,14 +4,18 @@
 import datetime
 import iso8601
 import logging
+import threading
+import time
 import xlwt as excel
 from StringIO import StringIO
-from matplotlib.dates import date2num
+from iso8601.iso8601 import UTC
 
 from django.shortcuts import render_to_response
-from django.core.cache import cache
 from django.views.generic.base import View
+from django.core.cache import cache
 from django.http import HttpResponse
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date
 from django.utils import simplejson as json
 from django.template import Context
 from django.template.loader import get_template
@@ -19,24 +23,45 @@ from django.template.loader import get_template
 
 from lizard_graph.models import PredefinedGraph
 from lizard_graph.models import GraphItem
+from lizard_graph.models import geo_locations_by_ident
+from lizard_graph.models import graph_plan
+from lizard_graph.caching import RENDER_CACHE_TIMEOUT
+from lizard_graph.caching import cached_chunked
+from lizard_graph.caching import etag_matches
+from lizard_graph.caching import in_background
+from lizard_graph.caching import month_chunks
+from lizard_graph.caching import period_start
+from lizard_graph.caching import render_cache_key
+from lizard_graph.caching import rendered_from_response
+from lizard_graph.caching import single_flight
+from lizard_graph.caching import year_chunks
+from lizard_graph.columnar import ColumnarSeries
+from lizard_graph.columnar import as_time_series
+from lizard_graph.columnar import date_number
+from lizard_graph.downsampling import downsample
+from lizard_graph.fetch import SeriesResolver
+from lizard_graph.stacking import MAX_GRID_POINTS_PER_PIXEL
+from lizard_graph.stacking import auto_grid_step
+from lizard_graph.stacking import stack_bars
+from lizard_graph.stacking import stack_lines
+from lizard_graph.stacking import time_grid
+from lizard_graph.spec import TIME_SERIES_ALL
+from lizard_graph.spec import TIME_SERIES_NEGATIVE
+from lizard_graph.spec import TIME_SERIES_POSITIVE
+from lizard_graph.spec import sign_split
+from lizard_graph.fetch import time_series_aggregated_bulk
+from lizard_graph.fetch import time_series_bulk
+from lizard_graph.fetch import watermarks_bulk
 
 from nens_graph.common import DateGridGraph
 
-from lizard_map.dateperiods import next_month
-from lizard_map.dateperiods import next_year
-from lizard_map.dateperiods import next_quarter
-from lizard_map.dateperiods import next_day
-
 from lizard_fewsnorm.models import GeoLocationCache
 
 
 logger = logging.getLogger(__name__)
 
-
-# Used by time_series_aggregated to 'flag' a time series.
-TIME_SERIES_ALL = 1
-TIME_SERIES_POSITIVE = 2
-TIME_SERIES_NEGATIVE = 3
+# Matplotlib is not thread safe, graphs are drawn one at a time.
+render_lock = threading.Lock()
 
 
 def graph_window(request):
@@ -55,87 +80,176 @@ def graph_window(request):
         mimetype='text/html')
 
 
+def time_series_key(graph_item):
+    """
+    Key prefix for the cached (chunks of) time series of graph_item.
+    """
+    return ('ts::%s:%s:%s:%s:%s:%s:%s:%s' % (
+        graph_item.fews_norm_source.database_name, graph_item.location,
+        graph_item.location_postpend,
+        graph_item.related_location,
+        graph_item.parameter, graph_item.module, graph_item.time_step,
+        graph_item.qualifierset)).replace(' ', '_')
+
+
+def agg_time_series_key(graph_item, aggregation, aggregation_period):
+    """
+    Key prefix for the cached (chunks of) aggregated time series of
+    graph_item.
+    """
+    return ('ts_agg::%s:%s:%s:%s:%s:%s:%s:%s::%s:%s' % (
+        graph_item.fews_norm_source.database_name, graph_item.location,
+        graph_item.location_postpend,
+        graph_item.related_location,
+        graph_item.parameter, graph_item.module, graph_item.time_step,
+        graph_item.qualifierset, aggregation,
+        aggregation_period)).replace(' ', '_')
+
+
 def cached_time_series_aggregated(graph_item, start, end,
-                                  aggregation, aggregation_period):
+                                  aggregation, aggregation_period,
+                                  series_resolver=None):
     """
     Cached version of the time_series_aggregated
+
+    If a series_resolver is provided, it is used to look up the series.
+    Returns dict with TimeSeries.
     """
-    def agg_time_series_key(
-        graph_item, start, end, aggregation, aggregation_period):
-
-        return ('ts_agg::%s:%s:%s:%s:%s:%s:%s::%s:%s:%s:%s' % (
-            graph_item.fews_norm_source.database_name, graph_item.location,
-            graph_item.location_postpend,
-            graph_item.parameter, graph_item.module, graph_item.time_step,
-            graph_item.qualifierset, start, end, aggregation,
-            aggregation_period)).replace(' ', '_')
-
-    cache_key = agg_time_series_key(
-        graph_item, start, end, aggregation, aggregation_period)
-    ts_agg = cache.get(cache_key)
-    if ts_agg is None:
-        ts_agg = graph_item.time_series_aggregated(
-            aggregation, aggregation_period, dt_start=start, dt_end=end)
-        cache.set(cache_key, ts_agg)
-    return ts_agg
-
-
-def cached_time_series_from_graph_item(graph_item, start, end):
+    if series_resolver is None:
+        series_resolver = SeriesResolver([graph_item])
+    result = cached_time_series_aggregated_from_graph_items(
+        [graph_item], start, end, aggregation, aggregation_period,
+        series_resolver)[id(graph_item)]
+    return dict([(key, ts.to_time_series())
+                 for key, ts in sign_split(result).items()])
+
+
+def cached_time_series_from_graph_item(graph_item, start, end,
+                                       series_resolver=None):
     """
     Cached version of graph_item.time_series(start, end)
+
+    If a series_resolver is provided, it is used to look up the series.
+    Returns dict with TimeSeries.
     """
-    def time_series_key(graph_item, start, end):
-        return ('ts::%s:%s:%s:%s:%s:%s:%s:%s::%s:%s' % (
-            graph_item.fews_norm_source.database_name, graph_item.location,
-            graph_item.location_postpend,
-            graph_item.related_location,
-            graph_item.parameter, graph_item.module, graph_item.time_step,
-            graph_item.qualifierset, start, end)).replace(' ', '_')
-    cache_key = time_series_key(graph_item, start, end)
-    ts = cache.get(cache_key)
-    if ts is None:
-        series = graph_item.series()
-        ts = graph_item.time_series(series=series, dt_start=start, dt_end=end)
-        cache.set(cache_key, ts)
-    return ts
+    if series_resolver is None:
+        series_resolver = SeriesResolver([graph_item])
+    result = cached_time_series_from_graph_items(
+        [graph_item], start, end, series_resolver)[id(graph_item)]
+    return dict([(key, ts.to_time_series()) for key, ts in result.items()])
+
 
+def cached_time_series_from_graph_items(graph_items, start, end,
+                                        series_resolver, expire_after=None):
+    """
+    Bulk version of cached_time_series_from_graph_item.
+
+    The time series are cached per calendar month. Missing or changed
+    months are fetched with a single events query per
+    fews_norm_source. Returns dict id(graph_item) -> dict with
+    ColumnarSeries.
+
+    See cached_chunked for expire_after.
+    """
+    return cached_chunked(
+        [graph_item for graph_item in graph_items
+         if graph_item.fews_norm_source is not None],
+        time_series_key,
+        month_chunks(start, end),
+        lambda missing, fetch_start, fetch_end: time_series_bulk(
+            missing, fetch_start, fetch_end, series_resolver),
+        lambda items, chunks: watermarks_bulk(
+            items, chunks, series_resolver),
+        start, end, expire_after=expire_after)
+
+
+def cached_time_series_aggregated_from_graph_items(
+    graph_items, start, end, aggregation, aggregation_period,
+    series_resolver, expire_after=None):
+    """
+    Bulk version of cached_time_series_aggregated.
+
+    The aggregated time series are cached per calendar year, so always
+    whole aggregation periods are used. Missing or changed years are
+    fetched with a single events query per fews_norm_source. Returns
+    dict id(graph_item) -> dict with ColumnarSeries.
+
+    See cached_chunked for expire_after.
+    """
+    return cached_chunked(
+        [graph_item for graph_item in graph_items
+         if graph_item.fews_norm_source is not None],
+        lambda graph_item: agg_time_series_key(
+            graph_item, aggregation, aggregation_period),
+        year_chunks(start, end),
+        lambda missing, fetch_start, fetch_end: time_series_aggregated_bulk(
+            missing, aggregation, aggregation_period,
+            fetch_start, fetch_end, series_resolver),
+        lambda items, chunks: watermarks_bulk(
+            items, chunks, series_resolver),
+        period_start(start, aggregation_period), end,
+        expire_after=expire_after)
+
+
+def time_series_cumulative(ts, reset_period, in_place=False):
+    """
+    Return cumulative version of ts (ColumnarSeries or TimeSeries),
+    restarting every reset_period ('day', 'month', 'quarter', 'year').
 
-def time_series_cumulative(ts, reset_period):
-    def next_border(dt, reset_period):
-        reset_period = PredefinedGraph.PERIOD_REVERSE[reset_period]
-        if reset_period == PredefinedGraph.PERIOD_DAY:
-            next_start, next_end = next_day(dt)
-        elif reset_period == PredefinedGraph.PERIOD_MONTH:
-            next_start, next_end = next_month(dt)
-        elif reset_period == PredefinedGraph.PERIOD_QUARTER:
-            next_start, next_end = next_quarter(dt)
-        elif reset_period == PredefinedGraph.PERIOD_YEAR:
-            next_start, next_end = next_year(dt)
-        return next_start
-
-    result = ts.clone(with_events=True)
-
-    last_event = None
-    last_timestamp = None
-    reset_border = None
+    If in_place, ts itself is changed and returned. Time series from
+    the cache can be shared, so only use in_place on your own copy.
+    """
+    if isinstance(ts, ColumnarSeries):
+        return ts.cumulative(reset_period, in_place=in_place)
+
+    result = ColumnarSeries.from_time_series(ts).cumulative(
+        reset_period, in_place=True)
+    if not in_place:
+        return result.to_time_series()
     for timestamp, event in result.get_events():
-        new_event = list(event)
-        if reset_border is None:
-            # Initial
-            reset_border = next_border(timestamp, reset_period)
-        if (last_timestamp and
-            last_timestamp < reset_border and timestamp >= reset_border):
-            # We're crossing the reset-border.
-            reset_border = next_border(timestamp, reset_period)
-            last_event = None
-            last_timestamp = None
-        if last_event is not None:
-            new_event[0] += last_event[0]
-        event_tuple = tuple(new_event)
-        result[timestamp] = event_tuple
-        last_event = event_tuple
-        last_timestamp = timestamp
+        ts[timestamp] = event
+    return ts
 
+
+def stacked_bar_components(graph_item, ts):
+    """
+    Return list of (key, stack, polarity, series) of the bars of a
+    stacked bar graph item, in drawing order. ts is its aggregated time
+    series dict.
+
+    The positive and negative parts of stacked-bar-sign are split off
+    here, other graph items do not need them.
+    """
+    result = []
+    if graph_item.graph_type == GraphItem.GRAPH_TYPE_STACKED_BAR:
+        if graph_item.value == 'negative':
+            stacked_key = 'bar-negative'
+            polarity = -1
+        else:
+            stacked_key = 'bar-positive'
+            polarity = 1
+        for key, single_ts in ts.items():
+            loc, par, option = key
+            if option == TIME_SERIES_ALL:
+                result.append((key, stacked_key, polarity, single_ts))
+    elif graph_item.graph_type == GraphItem.GRAPH_TYPE_STACKED_BAR_SIGN:
+        if graph_item.value == 'negative':
+            stacked_keys = {
+                TIME_SERIES_POSITIVE: ('bar-negative', -1),
+                TIME_SERIES_NEGATIVE: ('bar-positive', 1)}
+        else:
+            stacked_keys = {
+                TIME_SERIES_POSITIVE: ('bar-positive', 1),
+                TIME_SERIES_NEGATIVE: ('bar-negative', -1)}
+        for (loc, par, option), single_ts in ts.items():
+            if option != TIME_SERIES_ALL:
+                continue
+            for sign_option, positive in ((TIME_SERIES_POSITIVE, True),
+                                          (TIME_SERIES_NEGATIVE, False)):
+                stacked_key, polarity = stacked_keys[sign_option]
+                result.append((
+                        (loc, par, sign_option), stacked_key, polarity,
+                        single_ts.sign_part(positive)))
     return result
 
 
@@ -152,14 +266,17 @@ class TimeSeriesViewMixin(object):
         end = self.request.GET.get('dt_end', None)
 
         if start is None:
-            # A random default
-            dt_start = datetime.datetime.now() - datetime.timedelta(days=365)
+            # A random default. In UTC, like the parsed dates.
+            dt_start = datetime.datetime.now(UTC).replace(
+                second=0, microsecond=0) - datetime.timedelta(days=365)
         else:
             dt_start = iso8601.parse_date(start)
 
         if end is None:
-            # A random default
-            dt_end = datetime.datetime.now()
+            # A random default. Rounded, so the cache keys of default
+            # requests are stable.
+            dt_end = datetime.datetime.now(UTC).replace(
+                second=0, microsecond=0)
         else:
             dt_end = iso8601.parse_date(end)
 
@@ -251,10 +368,22 @@ class GraphView(View, TimeSeriesViewMixin):
         PredefinedGraph.PERIOD_QUARTER: 90,
         PredefinedGraph.PERIOD_YEAR: 365,
         }
+    # Graph types that need (aggregated) time series.
+    GRAPH_TYPES_TIME_SERIES = (
+        GraphItem.GRAPH_TYPE_LINE,
+        GraphItem.GRAPH_TYPE_STACKED_LINE,
+        GraphItem.GRAPH_TYPE_STACKED_LINE_CUMULATIVE,
+        )
+    GRAPH_TYPES_TIME_SERIES_AGGREGATED = (
+        GraphItem.GRAPH_TYPE_STACKED_BAR,
+        GraphItem.GRAPH_TYPE_STACKED_BAR_SIGN,
+        )
+    # Formats that export the data instead of drawing it.
+    DATA_FORMATS = ('csv', 'html', 'xls')
 
     def _graph_items_from_request(self):
         """
-        Return list of graph items from request.
+        Return list of graph items (GraphItemSpecs) from request.
 
         The graph items are created in memory or retrieved from memory.
         """
@@ -268,22 +397,35 @@ class GraphView(View, TimeSeriesViewMixin):
             'legend-location': -1,
             'flags': False,
             'now-line': False,
+            'downsample': True,
+            'stack-grid-step': None,
             'format': 'png',
             'unit_as_y_label': False,  # Take unit as y-label
             }
         get = self.request.GET
 
-        # Using the shortcut graph=<graph-slug>
+        # Parse all items first, so all locations can be looked up at
+        # once.
+        graph_item_dicts = [
+            json.loads(graph_item_json)
+            for graph_item_json in self.request.GET.getlist('item')]
+        location_idents = [
+            graph_item_dict['location'] for graph_item_dict in graph_item_dicts
+            if 'location' in graph_item_dict]
         predefined_graph_slug = get.get('graph', None)
+        location_get = get.get('location', None)
+        if predefined_graph_slug is not None and location_get is not None:
+            location_idents.append(location_get)
+        locations = geo_locations_by_ident(location_idents)
+
+        # Using the shortcut graph=<graph-slug>
         if predefined_graph_slug is not None:
             # Add all graph items of graph to result
-            location_get = get.get('location', None)
             if location_get is not None:
                 # If multiple instances, just take one.
-                try:
-                    location_get = GeoLocationCache.objects.filter(
-                        ident=location_get)[0]
-                except IndexError:
+                if location_get in locations:
+                    location_get = locations[location_get]
+                else:
                     # Beware: read-only. Throw away this 'useless'
                     # exception message.
                     logger.error(
@@ -292,30 +434,25 @@ class GraphView(View, TimeSeriesViewMixin):
                     location_get = GeoLocationCache(ident=location_get)
                     # This item is probably not going to show, because
                     # the fews_norm_source is not defined.
-            try:
-                predefined_graph = PredefinedGraph.objects.get(
-                    slug=predefined_graph_slug)
-                graph_settings.update(predefined_graph.graph_settings())
-                result.extend(predefined_graph.unfolded_graph_items(
-                        location=location_get))
-            except PredefinedGraph.DoesNotExist:
-                logger.exception("Tried to fetch a non-existing predefined "
-                                 "graph %s" % predefined_graph_slug)
-
-        # All standard items: make memory objects of them.
-        graph_items_json = self.request.GET.getlist('item')
-        for graph_item_json in graph_items_json:
-            # Create memory object for each graph_item and append to result.
-            graph_item_dict = json.loads(graph_item_json)
-            graph_items = GraphItem.from_dict(graph_item_dict)
-            result.extend(graph_items)
+            plan = graph_plan(predefined_graph_slug)
+            if plan is not None:
+                graph_settings.update(plan.graph_settings)
+                result.extend(plan.unfolded_specs(location=location_get))
+            else:
+                logger.error("Tried to fetch a non-existing predefined "
+                             "graph %s" % predefined_graph_slug)
+
+        # All standard items: make specs of them.
+        for graph_item_dict in graph_item_dicts:
+            result.extend(GraphItem.specs_from_dict(
+                    graph_item_dict, locations=locations))
 
         # Graph settings can be overruled
         graph_parameters = [
             'title', 'x-label', 'y-label', 'y-range-min', 'y-range-max',
             'aggregation', 'aggregation-period', 'reset-period', 'width',
-            'height', 'legend-location', 'flags', 'now-line', 'format',
-            'unit_as_y_label', ]
+            'height', 'legend-location', 'flags', 'now-line', 'downsample',
+            'stack-grid-step', 'format', 'unit_as_y_label', ]
         for graph_parameter in graph_parameters:
             if graph_parameter in get:
                 graph_settings[graph_parameter] = get[graph_parameter]
@@ -328,6 +465,27 @@ class GraphView(View, TimeSeriesViewMixin):
         except ValueError:
             pass
 
+        # Unknown aggregations and periods would break aggregation and
+        # cumulation later on: fall back to the default.
+        for graph_parameter, allowed, default in (
+            ('aggregation', PredefinedGraph.AGGREGATION_REVERSE, 'sum'),
+            ('aggregation-period', PredefinedGraph.PERIOD_REVERSE, 'month'),
+            ('reset-period', PredefinedGraph.PERIOD_REVERSE, 'month')):
+            if graph_settings[graph_parameter] not in allowed:
+                logger.warning('Unknown %s %s, using %s instead.' % (
+                        graph_parameter, graph_settings[graph_parameter],
+                        default))
+                graph_settings[graph_parameter] = default
+
+        if graph_settings['downsample'] in ('False', 'false', '0'):
+            graph_settings['downsample'] = False
+        if graph_settings['stack-grid-step'] is not None:
+            try:
+                graph_settings['stack-grid-step'] = int(
+                    graph_settings['stack-grid-step'])
+            except ValueError:
+                graph_settings['stack-grid-step'] = None
+
         return result, graph_settings
 
     def get(self, request, *args, **kwargs):
@@ -343,12 +501,169 @@ class GraphView(View, TimeSeriesViewMixin):
         - type can be 'line', 'stacked-bar', 'vertical-line',
           'horizontal-line', 'stacked-line' (see README).
         - items are processed in order.
-        """
-        default_colors = ['green', 'blue', 'yellow', 'magenta', ]
 
+        Rendered graphs are cached. The response has an ETag, requests
+        with a matching If-None-Match get a 304 Not Modified.
+        """
         dt_start, dt_end = self._dt_from_request()
+        stale_after, expire_after = self._cache_policy()
+        render_stale_after = stale_after or RENDER_CACHE_TIMEOUT
+        render_expire_after = max(
+            expire_after or RENDER_CACHE_TIMEOUT, render_stale_after)
+
+        cache_key = render_cache_key(request.GET, dt_start, dt_end)
+
+        def render_and_cache():
+            response, complete = self.render_graph(
+                dt_start, dt_end, expire_after=expire_after)
+            rendered = rendered_from_response(response)
+            # A graph without the data that failed to fetch is not
+            # cached, the next request tries again.
+            if complete:
+                cache.set(cache_key, rendered, render_expire_after)
+            return rendered
+
+        rendered = cache.get(cache_key)
+        if rendered is not None:
+            age = time.time() - rendered['last_modified']
+            if age > render_expire_after:
+                rendered = None
+            elif (age > render_stale_after and
+                  single_flight.acquire('refresh::%s' % cache_key)):
+                # Stale while revalidate.
+                def refresh():
+                    try:
+                        render_and_cache()
+                    finally:
+                        single_flight.release('refresh::%s' % cache_key)
+                if not in_background(refresh):
+                    single_flight.release('refresh::%s' % cache_key)
+        if rendered is None:
+            rendered = render_and_cache()
+        return self._response_from_rendered(rendered)
+
+    def _cache_policy(self):
+        """
+        Return (stale_after, expire_after) in seconds of the requested
+        predefined graph. Both are None when not configured.
+        """
+        predefined_graph_slug = self.request.GET.get('graph', None)
+        if predefined_graph_slug is None:
+            return None, None
+        plan = graph_plan(predefined_graph_slug)
+        if plan is None:
+            return None, None
+        return plan.cache_stale_after, plan.cache_expire_after
+
+    def _response_from_rendered(self, rendered):
+        """
+        Return (conditional) response for a rendered graph.
+        """
+        if etag_matches(self.request, rendered['etag']):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(
+                rendered['content'], content_type=rendered['content_type'])
+            if rendered['content_disposition']:
+                response['Content-Disposition'] = rendered[
+                    'content_disposition']
+        response['ETag'] = rendered['etag']
+        response['Last-Modified'] = http_date(rendered['last_modified'])
+        return response
+
+    def fetch_time_series(self, graph_items, graph_settings, dt_start,
+                          dt_end, series_resolver=None, expire_after=None):
+        """
+        Return (time_series, complete). time_series is a dict
+        id(graph_item) -> time series dict of all graph items that need
+        (aggregated) time series. The time series come from the cache
+        where possible. complete is False when fetching failed for some
+        of the graph items.
+        """
+        if series_resolver is None:
+            series_resolver = SeriesResolver(graph_items)
+        time_series = {}
+        try:
+            time_series.update(cached_time_series_from_graph_items(
+                    [graph_item for graph_item in graph_items
+                     if graph_item.graph_type in
+                     GraphView.GRAPH_TYPES_TIME_SERIES],
+                    dt_start, dt_end, series_resolver,
+                    expire_after=expire_after))
+            time_series.update(cached_time_series_aggregated_from_graph_items(
+                    [graph_item for graph_item in graph_items
+                     if graph_item.graph_type in
+                     GraphView.GRAPH_TYPES_TIME_SERIES_AGGREGATED],
+                    dt_start, dt_end,
+                    aggregation=graph_settings['aggregation'],
+                    aggregation_period=graph_settings['aggregation-period'],
+                    series_resolver=series_resolver,
+                    expire_after=expire_after))
+        except:
+            logger.exception("Unknown error while fetching time series.")
+            return time_series, False
+        # Graph items of a fewsnorm source are left out when their
+        # source could not be queried.
+        complete = not [
+            graph_item for graph_item in graph_items
+            if (graph_item.graph_type in GraphView.GRAPH_TYPES_TIME_SERIES or
+                graph_item.graph_type in
+                GraphView.GRAPH_TYPES_TIME_SERIES_AGGREGATED) and
+            graph_item.fews_norm_source is not None and
+            id(graph_item) not in time_series]
+        return time_series, complete
+
+    def _stack_grid(self, graph_settings, dt_start, dt_end):
+        """
+        Return time grid for the stacked lines, or None.
+
+        The grid is opt-in: the step is stack-grid-step seconds, without
+        it (or with 0) lines are stacked on their exact timestamps. The
+        grid samples the lines (LOCF), so peaks between grid points are
+        not drawn. Smaller steps are clamped to at most
+        MAX_GRID_POINTS_PER_PIXEL points per pixel.
+        """
+        step = graph_settings['stack-grid-step']
+        if not step or step <= 0:
+            return None
+        width = int(graph_settings['width'])
+        step = max(step, auto_grid_step(
+                dt_start, dt_end, MAX_GRID_POINTS_PER_PIXEL * width))
+        return time_grid(dt_start, dt_end, step)
+
+    def render_graph(self, dt_start, dt_end, expire_after=None):
+        """
+        Draw the graph and return (response, complete). complete is
+        False when fetching time series failed: such a response is not
+        to be cached.
+
+        If expire_after (seconds) is given, cached time series with
+        changed data that are younger than that are used, while they
+        are refreshed in the background.
+        """
         # Get all graph items from request.
         graph_items, graph_settings = self._graph_items_from_request()
+        # Series of all graph items are looked up in one go.
+        series_resolver = SeriesResolver(graph_items)
+
+        # Fetch the data of all graph items at once.
+        time_series, complete = self.fetch_time_series(
+            graph_items, graph_settings, dt_start, dt_end,
+            series_resolver=series_resolver, expire_after=expire_after)
+
+        # Matplotlib is not thread safe: draw one graph at a time.
+        with render_lock:
+            response = self._draw_graph(
+                graph_items, graph_settings, time_series, dt_start, dt_end)
+        return response, complete
+
+    def _draw_graph(self, graph_items, graph_settings, time_series,
+                    dt_start, dt_end):
+        """
+        Draw graph_items with their time_series and return the response.
+        """
+        default_colors = ['green', 'blue', 'yellow', 'magenta', ]
+
         graph = DateGridGraph(
             width=int(graph_settings['width']),
             height=int(graph_settings['height']))
@@ -369,29 +684,69 @@ class GraphView(View, TimeSeriesViewMixin):
 
         color_index = 0
         unit_from_graph = '(no unit)'
-        ts_stacked_sum = {
-            'bar-positive': 0,
-            'bar-negative': 0,
-            'line-cum': 0,
-            'line': 0}
         matplotlib_legend_index = 0
 
         # To be filled using matplotlib_legend_index
         reversed_legend_items = []
 
+        # Stack all bars at once. Components are named by the position
+        # of their graph item: the same graph item (spec) can occur more
+        # than once, and then it is stacked more than once.
+        bar_components = []
+        bar_keys = {}  # position -> [(key, polarity)]
+        for position, graph_item in enumerate(graph_items):
+            bar_keys[position] = []
+            for key, stacked_key, polarity, single_ts in (
+                stacked_bar_components(
+                    graph_item, time_series.get(id(graph_item), {}))):
+                bar_keys[position].append((key, polarity))
+                bar_components.append(
+                    ((position, key), stacked_key, polarity, single_ts))
+        bars = stack_bars(bar_components)
+
+        # Stack all lines at once.
+        line_components = []
+        for position, graph_item in enumerate(graph_items):
+            ts = time_series.get(id(graph_item), {})
+            if graph_item.graph_type == GraphItem.GRAPH_TYPE_STACKED_LINE:
+                for key, single_ts in ts.items():
+                    line_components.append(
+                        ((position, key), 'line', single_ts))
+            elif (graph_item.graph_type ==
+                  GraphItem.GRAPH_TYPE_STACKED_LINE_CUMULATIVE):
+                for key, single_ts in ts.items():
+                    line_components.append(
+                        ((position, key), 'line-cum',
+                         time_series_cumulative(
+                                single_ts, graph_settings['reset-period'])))
+        lines = {}
+        if line_components:
+            lines = stack_lines(
+                line_components, grid=self._stack_grid(
+                    graph_settings, dt_start, dt_end))
+
+        # Line items are reduced to what can be seen at this width.
+        downsample_width = None
+        if (graph_settings['downsample'] and
+            graph_settings['format'] not in GraphView.DATA_FORMATS):
+            downsample_width = int(graph_settings['width'])
+
         # Let's draw these graph items.
-        for graph_item in graph_items:
+        for position, graph_item in enumerate(graph_items):
             graph_type = graph_item.graph_type
 
             try:
                 if graph_type == GraphItem.GRAPH_TYPE_LINE:
-                    ts = cached_time_series_from_graph_item(
-                        graph_item, dt_start, dt_end)
+                    ts = time_series[id(graph_item)]
                     for (loc, par, unit), single_ts in ts.items():
                         if unit:
                             unit_from_graph = unit
+                        if downsample_width:
+                            single_ts = downsample(
+                                single_ts, dt_start, dt_end, downsample_width,
+                                keep_flagged=graph_settings['flags'])
                         matplotlib_legend_index += graph.line_from_single_ts(
-                            single_ts, graph_item,
+                            as_time_series(single_ts), graph_item,
                             default_color=default_colors[color_index],
                             flags=graph_settings['flags'])
 
@@ -399,25 +754,14 @@ class GraphView(View, TimeSeriesViewMixin):
                 elif (graph_type ==
                       GraphItem.GRAPH_TYPE_STACKED_LINE_CUMULATIVE or
                       graph_type == GraphItem.GRAPH_TYPE_STACKED_LINE):
-                    ts = cached_time_series_from_graph_item(
-                        graph_item, dt_start, dt_end)
-                    for (loc, par, unit), single_ts in ts.items():
+                    ts = time_series[id(graph_item)]
+                    for key in ts.keys():
+                        loc, par, unit = key
                         if unit:
                             unit_from_graph = unit
-                        if (graph_type == GraphItem.GRAPH_TYPE_STACKED_LINE):
-                            current_ts = single_ts
-                            stacked_key = 'line'
-                        else:
-                            current_ts = time_series_cumulative(
-                                single_ts, graph_settings['reset-period'])
-                            stacked_key = 'line-cum'
-                        # cum_ts is bottom_ts + cumulative single_ts
-                        # Make last observation carried forward
-                        current_ts.is_locf = True
-                        ts_stacked_sum[stacked_key] = (
-                            current_ts + ts_stacked_sum[stacked_key])
                         added = graph.line_from_single_ts(
-                            ts_stacked_sum[stacked_key], graph_item,
+                            as_time_series(lines[position, key]),
+                            graph_item,
                             default_color=default_colors[color_index],
                             flags=False)
                         # Mark these items to be reversed in the legend.
@@ -429,80 +773,31 @@ class GraphView(View, TimeSeriesViewMixin):
                 elif graph_type == GraphItem.GRAPH_TYPE_HORIZONTAL_LINE:
                     matplotlib_legend_index += graph.horizontal_line(
                         graph_item.value,
-                        graph_item.layout_dict(),
+                        graph_item.layout_as_dict(),
                         default_color=default_colors[color_index])
                     color_index = (color_index + 1) % len(default_colors)
                 elif graph_type == GraphItem.GRAPH_TYPE_VERTICAL_LINE:
                     matplotlib_legend_index += graph.vertical_line(
                         graph_item.value,
-                        graph_item.layout_dict(),
+                        graph_item.layout_as_dict(),
                         default_color=default_colors[color_index])
                     color_index = (color_index + 1) % len(default_colors)
-                elif graph_type == GraphItem.GRAPH_TYPE_STACKED_BAR:
-                    ts = cached_time_series_aggregated(
-                        graph_item, dt_start, dt_end,
-                        aggregation=graph_settings['aggregation'],
-                        aggregation_period=graph_settings[
-                            'aggregation-period'])
-                    if graph_item.value == 'negative':
-                        stacked_key = 'bar-negative'
-                        polarity = -1
-                    else:
-                        stacked_key = 'bar-positive'
-                        polarity = 1
-                    for (loc, par, option), single_ts in ts.items():
-                        if option == TIME_SERIES_ALL:
-                            # Make sure all timestamps are present.
-                            ts_stacked_sum[stacked_key] += single_ts * 0
-                            abs_single_ts = polarity * abs(single_ts)
-                            added = graph.bar_from_single_ts(
-                                abs_single_ts, graph_item, bar_width,
-                                default_color=default_colors[color_index],
-                                bottom_ts=ts_stacked_sum[stacked_key])
-                            # Mark these items to be reversed in the legend.
-                            if polarity == 1:
-                                reversed_legend_items.extend(
-                                    range(matplotlib_legend_index,
-                                          matplotlib_legend_index + added))
-                            matplotlib_legend_index += added
-                            ts_stacked_sum[stacked_key] += abs_single_ts
-                            color_index = (color_index + 1) % len(
-                                default_colors)
-                elif graph_type == GraphItem.GRAPH_TYPE_STACKED_BAR_SIGN:
-                    ts = cached_time_series_aggregated(
-                        graph_item, dt_start, dt_end,
-                        aggregation=graph_settings['aggregation'],
-                        aggregation_period=graph_settings[
-                            'aggregation-period'])
-                    if graph_item.value == 'negative':
-                        stacked_key_positive = 'bar-negative'
-                        stacked_key_negative = 'bar-positive'
-                        polarity = {
-                            TIME_SERIES_POSITIVE: -1,
-                            TIME_SERIES_NEGATIVE: 1}
-                    else:
-                        stacked_key_positive = 'bar-positive'
-                        stacked_key_negative = 'bar-negative'
-                        polarity = {
-                            TIME_SERIES_POSITIVE: 1,
-                            TIME_SERIES_NEGATIVE: -1}
-                    for (loc, par, option), single_ts in ts.items():
-                        # Make sure all timestamps are present.
-                        if option == TIME_SERIES_POSITIVE:
-                            stacked_key = stacked_key_positive
-                        elif option == TIME_SERIES_NEGATIVE:
-                            stacked_key = stacked_key_negative
-                        if (option == TIME_SERIES_POSITIVE or
-                            option == TIME_SERIES_NEGATIVE):
-                            ts_stacked_sum[stacked_key] += single_ts * 0
-                            abs_single_ts = polarity[option] * abs(single_ts)
-                            matplotlib_legend_index += graph.bar_from_single_ts(
-                                abs_single_ts, graph_item, bar_width,
-                                default_color=default_colors[color_index],
-                                bottom_ts=ts_stacked_sum[stacked_key])
-                            ts_stacked_sum[stacked_key] += abs_single_ts
-                            color_index = (color_index + 1) % len(
-                                default_colors)
+                elif (graph_type == GraphItem.GRAPH_TYPE_STACKED_BAR or
+                      graph_type == GraphItem.GRAPH_TYPE_STACKED_BAR_SIGN):
+                    for key, polarity in bar_keys[position]:
+                        bar_ts, bottom_ts = bars[position, key]
+                        added = graph.bar_from_single_ts(
+                            as_time_series(bar_ts), graph_item, bar_width,
+                            default_color=default_colors[color_index],
+                            bottom_ts=as_time_series(bottom_ts))
+                        # Mark these items to be reversed in the legend.
+                        if (graph_type == GraphItem.GRAPH_TYPE_STACKED_BAR and
+                            polarity == 1):
+                            reversed_legend_items.extend(
+                                range(matplotlib_legend_index,
+                                      matplotlib_legend_index + added))
+                        matplotlib_legend_index += added
+                        color_index = (color_index + 1) % len(default_colors)
             except:
                 # You never know if there is a bug somewhere
                 logger.exception("Unknown error while drawing graph item.")
@@ -515,7 +810,7 @@ class GraphView(View, TimeSeriesViewMixin):
         if graph_settings.get('unit_as_y_label', False):
             graph.axes.set_ylabel(unit_from_graph)
 
-        graph.axes.set_xlim(date2num((dt_start, dt_end)))
+        graph.axes.set_xlim(date_number(dt_start), date_number(dt_end))
 
         # Set ylim
         y_min = graph_settings.get('y-range-min', graph.axes.get_ylim()[0])
@@ -524,12 +819,18 @@ class GraphView(View, TimeSeriesViewMixin):
 
         # Now line?
         if graph_settings.get('now-line', False):
-            today = datetime.datetime.now()
-            graph.axes.axvline(today, color='orange', lw=2, ls='--')
+            now = date_number(datetime.datetime.now(UTC))
+            graph.axes.axvline(now, color='orange', lw=2, ls='--')
 
         # Set the margins, including legend.
         graph.set_margins()
 
+        return self._graph_response(graph, graph_settings)
+
+    def _graph_response(self, graph, graph_settings):
+        """
+        Return response with graph in the requested format.
+        """
         response_format = graph_settings['format']
         if response_format == 'csv':
             response = HttpResponse(mimetype='text/csv')
@@ -19,6 +19,7 @@ install_requires = [
     'timeseries',
     'xlwt',
     'nens-graph >= 0.13',
+    'numpy',
     'pkginfo',
     ],
 